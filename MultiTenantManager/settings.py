@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import copy
 from pathlib import Path
 import os
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "tenants.middleware.RequestLogMiddleware",
+    "tenants.middleware.QueryBudgetMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -53,6 +56,7 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "tenants.middleware.TokenAuthenticationMiddleware",
     'tenants.middleware.TenantMiddleware',
+    'tenants.middleware.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = "MultiTenantManager.urls"
@@ -77,15 +81,97 @@ WSGI_APPLICATION = "MultiTenantManager.wsgi.application"
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'mtm_db',
-        'USER': 'postgres',
-        'PASSWORD':'postgres',
-        'HOST': 'db',
-        'PORT': '5432',
+        'ENGINE': os.environ.get('DB_ENGINE', 'django.db.backends.postgresql'),
+        'NAME': os.environ.get('DB_NAME', 'mtm_db'),
+        'USER': os.environ.get('DB_USER', 'postgres'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', 'postgres'),
+        'HOST': os.environ.get('DB_HOST', 'db'),
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        # Persistent connections, checked before reuse
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# psycopg 3 connection pool (Django 5.1+), recommended when serving over
+# ASGI where persistent connections are not reused between requests.
+# The pool replaces CONN_MAX_AGE; with CONN_HEALTH_CHECKS Django has the pool
+# check connections when they are taken from it.
+# Every gunicorn worker has its own pool per database, so a database sees up
+# to workers x DB_POOL_MAX_SIZE connections; gunicorn.conf.py refuses to start
+# when that exceeds DB_MAX_CONNECTIONS (keep it below Postgres' max_connections).
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '90'))
+DB_POOL_OPTIONS = {
+    'min_size': min(int(os.environ.get('DB_POOL_MIN_SIZE', '2')), DB_POOL_MAX_SIZE),
+    'max_size': DB_POOL_MAX_SIZE,
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', '600')),
+}
+if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql' and os.environ.get('DB_POOL', '1') == '1':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {'pool': DB_POOL_OPTIONS}
+
+def database_from_env(alias, base):
+    # Same settings as `base` with DB_<ALIAS>_NAME, DB_<ALIAS>_HOST, ... overrides
+    database = copy.deepcopy(base)
+    for key in ('NAME', 'USER', 'PASSWORD', 'HOST', 'PORT'):
+        database[key] = os.environ.get(f'DB_{alias.upper()}_{key}', base[key])
+    return database
+
+# Tenant shards: extra databases listed in DB_SHARDS (e.g. "shard1,shard2"),
+# configured like the default one with DB_<SHARD>_NAME, DB_<SHARD>_HOST, ...
+# overrides. Organizations, departments and customers of a tenant live on
+# the database named by Tenant.shard (tenants.routers.TenantShardRouter).
+for shard in filter(None, os.environ.get('DB_SHARDS', '').split(',')):
+    DATABASES[shard] = database_from_env(shard, DATABASES['default'])
+
+# Ids of organizations, departments and customers come from a separate range
+# on every database: the default one and the shards, in DB_SHARDS order (add
+# new shards at the end), each get SHARD_ID_RANGE ids. `migrate_shards` sets
+# the counters, so tenants moved between databases keep their ids.
+SHARD_ID_RANGE = 10 ** 12
+
+# Read replicas of the default database (DB_REPLICAS) and of each shard
+# (DB_<SHARD>_REPLICAS), configured with DB_<REPLICA>_HOST, ... overrides.
+# GET/HEAD requests read from a replica unless the tenant or user wrote in
+# the last PIN_SECONDS; replicas lagging more than MAX_LAG seconds (checked
+# every LAG_CHECK_INTERVAL seconds) are skipped. When no replica is usable
+# reads go to the primary, or with FALLBACK_TO_PRIMARY off to a lagging replica.
+DATABASE_REPLICAS = {}
+for primary in list(DATABASES):
+    variable = 'DB_REPLICAS' if primary == 'default' else f'DB_{primary.upper()}_REPLICAS'
+    for replica in filter(None, os.environ.get(variable, '').split(',')):
+        DATABASES[replica] = database_from_env(replica, DATABASES[primary])
+        DATABASES[replica]['TEST'] = {'MIRROR': primary}
+        DATABASE_REPLICAS.setdefault(primary, []).append(replica)
+
+REPLICA_ROUTING = {
+    'PIN_SECONDS': int(os.environ.get('DB_REPLICA_PIN_SECONDS', '5')),
+    'MAX_LAG': float(os.environ.get('DB_REPLICA_MAX_LAG', '2')),
+    'LAG_CHECK_INTERVAL': 5,
+    'FALLBACK_TO_PRIMARY': True,
+}
+
+DATABASE_ROUTERS = ['tenants.routers.ReplicaRouter']
+
+# Generation counters, permission indexes, cached responses and replica pins
+# live in the default cache. It is per process by default, which is only
+# correct with a single worker; docker-compose points it at Redis
+# (CACHE_BACKEND=django.core.cache.backends.redis.RedisCache) so a write in
+# one worker invalidates what the others cached, and gunicorn.conf.py refuses
+# to start several workers on a per process cache.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+SHARED_CACHE = CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -107,13 +193,87 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {  
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'tenants.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    # Same output as JSONRenderer, rendered with orjson when it is installed
+    'DEFAULT_RENDERER_CLASSES': [
+        'tenants.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# Domain -> Tenant cache used by TenantMiddleware. Invalidation reaches the
+# local tier of the saving worker and the shared tier; other workers drop
+# stale entries after TTL / NEGATIVE_TTL seconds. Every worker logs its
+# hit/miss counters ('tenants.cache') at most every STATS_INTERVAL seconds.
+TENANT_CACHE = {
+    'MAX_SIZE': 1024,
+    'TTL': 60,
+    'NEGATIVE_TTL': 10,
+    'SHARED_CACHE_ALIAS': None,
+    'STATS_INTERVAL': 60,
 }
 
+# Page sizes of the cursor paginated list endpoints, clients can ask for
+# a different size with ?page_size= up to the maximum.
+PAGINATION_PAGE_SIZE = 100
+PAGINATION_MAX_PAGE_SIZE = 1000
+
+# Rows fetched per server-side cursor round trip by the streaming exports.
+EXPORT_CHUNK_SIZE = 2000
+
+# Limits of the bulk endpoints: rows per request and rows per INSERT.
+BULK_MAX_ROWS = 50000
+BULK_BATCH_SIZE = 1000
+
+# Background deletion of tenants and organizations (run_purge_worker): rows
+# per DELETE, seconds between polls, and seconds after which a running job
+# whose worker stopped updating it is taken over by another worker.
+PURGE = {
+    'BATCH_SIZE': 1000,
+    'POLL_INTERVAL': 5,
+    'LEASE': 300,
+}
+
+# Per request query budgets checked by QueryBudgetMiddleware, keyed by URL
+# name and method (e.g. ('customer-list', 'GET')). Over budget requests are
+# logged, with RAISE they fail instead (meant for tests). The middleware is
+# sync only, so it is off unless QUERY_BUDGET_ENABLED=1.
+QUERY_BUDGET = {
+    'ENABLED': os.environ.get('QUERY_BUDGET_ENABLED', '0') == '1',
+    'DEFAULT': 10,
+    'VIEWS': {
+        ('organization-list', 'GET'): 3,
+        ('department-list', 'GET'): 3,
+        ('customer-list', 'GET'): 3,
+        ('customer-search', 'GET'): 3,
+        ('organization-tree', 'GET'): 3,
+        ('stats-list', 'GET'): 2,
+    },
+    'RAISE': False,
+    'N_PLUS_ONE_THRESHOLD': 5,
+    'FLUSH_INTERVAL': 30,
+}
+
+# GET list/retrieve responses cached per tenant by TenantCachedResponseMixin.
+# Writes bump the tenant's generation counter, TTL only bounds memory usage.
+# On by default only with a shared cache, RESPONSE_CACHE=1 enables it for a
+# single process on the local memory cache.
+RESPONSE_CACHE = {
+    'ENABLED': os.environ.get('RESPONSE_CACHE', '1' if SHARED_CACHE else '0') == '1',
+    'TTL': 300,
+}
+
+# Seconds a resolved (user, token) snapshot is reused across requests.
+AUTH_SNAPSHOT_TTL = 60
+
+# Seconds a user's permission index is reused, bounds how long a revoked
+# permission can still be granted if a generation bump is missed.
+PERMISSION_INDEX_TTL = 60
+
 SWAGGER_SETTINGS = {
     'SECURITY_DEFINITIONS': {
         'api_key': {
@@ -123,6 +283,43 @@ SWAGGER_SETTINGS = {
         }
     },
 }
+# Application logs are written as JSON lines by a background thread
+# (tenants.log.QueueListenerHandler), so request threads never block on
+# stdout. DEBUG records are sampled with TENANTS_LOG_DEBUG_SAMPLE_RATE.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'tenants.log.StructuredFormatter',
+        },
+    },
+    'filters': {
+        'request_context': {
+            '()': 'tenants.log.RequestContextFilter',
+        },
+        'debug_sampling': {
+            '()': 'tenants.log.SamplingFilter',
+            'rate': os.environ.get('TENANTS_LOG_DEBUG_SAMPLE_RATE', '0.01'),
+        },
+    },
+    'handlers': {
+        'queue': {
+            '()': 'tenants.log.QueueListenerHandler',
+            'stream': 'ext://sys.stdout',
+            'formatter': 'structured',
+            'filters': ['request_context', 'debug_sampling'],
+        },
+    },
+    'loggers': {
+        'tenants': {
+            'handlers': ['queue'],
+            'level': os.environ.get('TENANTS_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
 
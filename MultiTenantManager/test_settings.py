@@ -0,0 +1,25 @@
+"""
+Settings for the test suite, run with
+
+    python manage.py test --settings=MultiTenantManager.test_settings
+
+SQLite databases for the default database, a tenant shard and a replica of
+the default database, which mirrors it in tests. ReplicaMiddleware is left
+out so queries stay on the primaries; replica tests add it back.
+"""
+
+from .settings import *  # noqa: F403
+
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'test_default.sqlite3'},
+    'shard1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'test_shard1.sqlite3'},
+    'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'test_default.sqlite3', 'TEST': {'MIRROR': 'default'}},
+}
+DATABASE_REPLICAS = {'default': ['replica']}
+MIDDLEWARE = [name for name in MIDDLEWARE if name != 'tenants.middleware.ReplicaMiddleware']  # noqa: F405
+
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+SHARED_CACHE = False
+
+# Request logs would interleave with the test runner's output
+LOGGING['loggers']['tenants']['level'] = 'WARNING'  # noqa: F405
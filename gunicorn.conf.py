@@ -0,0 +1,47 @@
+"""
+Gunicorn config for serving MultiTenantManager over ASGI.
+
+    gunicorn -c gunicorn.conf.py MultiTenantManager.asgi:application
+
+Every worker runs an uvicorn event loop, so a single process can keep many
+slow clients open while the tenant and token middlewares run natively async.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'uvicorn_worker.UvicornWorker'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Recycling workers from time to time keeps memory usage in check
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+accesslog = os.environ.get('GUNICORN_ACCESSLOG')
+
+def on_starting(server):
+    """Refuses worker counts the cache and the database connections cannot support."""
+    # Generation counters, permission indexes and cached responses live in the
+    # default cache; on a per process cache an invalidation made by one worker
+    # would never reach the others.
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MultiTenantManager.settings')
+    from django.conf import settings
+
+    backend = settings.CACHES['default']['BACKEND']
+    if server.cfg.workers > 1 and not settings.SHARED_CACHE:
+        raise RuntimeError(
+            f"{server.cfg.workers} workers cannot share {backend}; point CACHE_BACKEND/CACHE_LOCATION "
+            f"at a shared cache such as Redis or set GUNICORN_WORKERS=1."
+        )
+
+    # Every worker has its own connection pool per database
+    pools = [database for database in settings.DATABASES.values() if 'pool' in database.get('OPTIONS', {})]
+    connections = server.cfg.workers * settings.DB_POOL_MAX_SIZE
+    if pools and connections > settings.DB_MAX_CONNECTIONS:
+        raise RuntimeError(
+            f"{server.cfg.workers} workers with pools of {settings.DB_POOL_MAX_SIZE} connections can open "
+            f"{connections} connections per database, over DB_MAX_CONNECTIONS={settings.DB_MAX_CONNECTIONS}; "
+            f"lower GUNICORN_WORKERS or DB_POOL_MAX_SIZE."
+        )
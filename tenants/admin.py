@@ -1,7 +1,28 @@
 from django.contrib import admin
-from .models import  Tenant, Department, Organization, Customer
+from .models import  Tenant, Department, Organization, Customer, QueryStat, PurgeJob
 
 admin.site.register(Tenant)
 admin.site.register(Department)
 admin.site.register(Organization)
 admin.site.register(Customer)
+
+
+@admin.register(QueryStat)
+class QueryStatAdmin(admin.ModelAdmin):
+    list_display = ['view', 'requests', 'avg_queries', 'max_queries', 'avg_db_time_ms', 'budget_violations', 'n_plus_one', 'updated_at']
+    ordering = ['-queries']
+    readonly_fields = [field.name for field in QueryStat._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(PurgeJob)
+class PurgeJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'object_id', 'shard', 'status', 'attempts', 'created_at', 'finished_at']
+    list_filter = ['status', 'kind']
+    # A failed job is retried by setting it back to pending
+    readonly_fields = [field.name for field in PurgeJob._meta.fields if field.name != 'status']
+
+    def has_add_permission(self, request):
+        return False
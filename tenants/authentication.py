@@ -0,0 +1,61 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from tenants.cache import aget_generation, get_generation
+from tenants.permissions import aget_permission_index, get_permission_index
+
+
+def _snapshot_key(key, auth_generation, permissions_generation):
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return f"auth:token:{auth_generation}:{permissions_generation}:{digest}"
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+    TokenAuthentication that resolves a token at most once per request.
+
+    TokenAuthenticationMiddleware stores its result on the request, DRF reuses
+    it instead of authenticating again. Across requests the (user, token)
+    snapshot is kept in the cache for AUTH_SNAPSHOT_TTL seconds, together with
+    the permission index of the user, so permission checks do not hit the database.
+    The snapshot is dropped when tokens, users, groups or permissions change.
+    '''
+
+    def authenticate(self, request):
+        resolved = getattr(request._request, 'token_auth', None)
+        if resolved is not None:
+            return resolved
+        return super().authenticate(request)
+
+    def authenticate_credentials(self, key):
+        cache_key = _snapshot_key(key, get_generation('auth'), get_generation('permissions'))
+        snapshot = cache.get(cache_key)
+        if snapshot is None:
+            user, token = super().authenticate_credentials(key)
+            # The index is memoized on the user, so it is pickled together with it
+            get_permission_index(user)
+            snapshot = (user, token)
+            cache.set(cache_key, snapshot, getattr(settings, 'AUTH_SNAPSHOT_TTL', 60))
+        return snapshot
+
+    async def aauthenticate_credentials(self, key):
+        """Async version of `authenticate_credentials`, used by the middleware under ASGI."""
+        cache_key = _snapshot_key(key, await aget_generation('auth'), await aget_generation('permissions'))
+        snapshot = await cache.aget(cache_key)
+        if snapshot is None:
+            model = self.get_model()
+            try:
+                token = await model.objects.select_related('user').aget(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            if not token.user.is_active:
+                raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            await aget_permission_index(token.user)
+            snapshot = (token.user, token)
+            await cache.aset(cache_key, snapshot, getattr(settings, 'AUTH_SNAPSHOT_TTL', 60))
+        return snapshot
@@ -0,0 +1,125 @@
+import math
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.db import connections
+from django.test import Client
+
+from tenants.instrumentation import QueryTracker
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, elapsed, errors=0, queries=None):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 2),
+        'p95_ms': round(1000 * percentile(latencies, 0.95), 2),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 2),
+    }
+    if queries:
+        summary['queries_per_request'] = round(sum(queries) / len(queries), 2)
+        summary['max_queries'] = max(queries)
+    return summary
+
+
+class TestClientDriver:
+    '''
+    Sends requests through the Django test client, in process, with a client
+    per thread. Queries of each request are counted on every database.
+    '''
+
+    def __init__(self, domain, token):
+        self.headers = {'HTTP_HOST': f'{domain}.localhost', 'HTTP_AUTHORIZATION': f'token {token}'}
+        self._local = threading.local()
+
+    def get(self, path):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = Client(**self.headers)
+        tracker = QueryTracker()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(tracker))
+            response = client.get(path)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return response.status_code, tracker.count
+
+
+class HttpDriver:
+    '''Sends requests to a running server, queries are not known there.'''
+
+    def __init__(self, base_url, domain, token):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Host': f'{domain}.localhost', 'Authorization': f'token {token}'}
+
+    def get(self, path):
+        request = urllib.request.Request(self.base_url + path, headers=self.headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as exc:
+            return exc.code, None
+
+
+def run(driver, path, requests=500, concurrency=1, warmup=20):
+    """Sends `requests` GETs to `path` from `concurrency` threads and returns latency statistics."""
+    for _ in range(warmup):
+        driver.get(path)
+
+    def timed(_):
+        start = time.perf_counter()
+        status, queries = driver.get(path)
+        return time.perf_counter() - start, status, queries
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    errors = sum(1 for _, status, _ in results if status >= 400)
+    queries = [queries for _, _, queries in results if queries is not None]
+    return summarize([latency for latency, _, _ in results], elapsed, errors, queries)
+
+
+def suite_endpoints(organization_id, department_id, customer_id):
+    """(name, path) pairs of the GET endpoints, for objects of the benchmarked tenant."""
+    return [
+        ('tenant-list', '/api/tenants/'),
+        ('stats', '/api/stats/'),
+        ('organization-stats', f'/api/stats/?organization={organization_id}'),
+        ('organization-list', '/api/organizations/'),
+        ('organization-detail', f'/api/organizations/{organization_id}/'),
+        ('organization-tree', '/api/organizations/tree/'),
+        ('organization-export', f'/api/organizations/{organization_id}/export/'),
+        ('department-list', f'/api/departments/?organization={organization_id}'),
+        ('department-detail', f'/api/departments/{department_id}/'),
+        ('customer-list', f'/api/customers/?department={department_id}'),
+        ('customer-detail', f'/api/customers/{customer_id}/'),
+        ('customer-export', f'/api/customers/export/?department={department_id}'),
+        ('customer-search', '/api/customers/search/?q=first'),
+    ]
+
+
+def run_suite(driver, endpoints, requests=200, concurrency=1, warmup=10):
+    """Runs `run` for every (name, path) endpoint, returns a list of per endpoint results."""
+    return [
+        {'endpoint': name, 'path': path, **run(driver, path, requests, concurrency, warmup)}
+        for name, path in endpoints
+    ]
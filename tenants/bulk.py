@@ -0,0 +1,177 @@
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import F
+from rest_framework.exceptions import ValidationError
+
+from .cache import bump_generation, tenant_scope
+from .counters import objects_created
+from .models import Organization, Department, Customer
+from .search import index_customers
+from .serializers import DepartmentBulkSerializer, CustomerBulkSerializer
+
+
+class BulkWriter:
+    '''
+    Validates and writes a batch of rows of one model for a tenant.
+
+    Rows are validated one by one without touching the database, ownership of
+    the parents is checked for the whole batch with one query and the rows are
+    written with `bulk_create` in chunks. With `upsert` rows matching an
+    existing (parent, natural key) pair update that row instead, or are left
+    unchanged when the model has no `update_fields`; of rows repeating a pair
+    in the request the last one is written and the others are reported.
+    Invalid rows are reported with their index and do not stop the batch.
+    '''
+    model = None
+    serializer_class = None
+    parent_field = None
+    parent_model = None
+    natural_key = None
+    update_fields = []
+    # Extra conditions on the parents rows may be written under
+    parent_filter = {}
+
+    def __init__(self, tenant, upsert=False):
+        self.tenant = tenant
+        self.upsert = upsert
+        self.db = router.db_for_write(self.model, instance=tenant)
+        self.batch_size = getattr(settings, 'BULK_BATCH_SIZE', 1000)
+        self.max_rows = getattr(settings, 'BULK_MAX_ROWS', 50000)
+
+    def write(self, rows):
+        """Returns a report: numbers of created, updated and unchanged rows and per-row errors."""
+        if not isinstance(rows, list):
+            raise ValidationError({"detail": "Expected a list of objects."})
+        if len(rows) > self.max_rows:
+            raise ValidationError({"detail": f"A single request can contain at most {self.max_rows} rows."})
+
+        errors = []
+        valid = []
+        for index, row in enumerate(rows):
+            serializer = self.serializer_class(data=row)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                errors.append({'index': index, 'errors': serializer.errors})
+
+        owned = self.owned_parents({data[self.parent_field] for _, data in valid})
+        objects = []
+        for index, data in valid:
+            if data[self.parent_field] not in owned:
+                errors.append({
+                    'index': index,
+                    'errors': {self.parent_field: [f"Invalid {self.parent_field} for the current tenant."]},
+                })
+                continue
+            objects.append((index, self.build(data)))
+        if self.upsert:
+            objects = self.drop_duplicates(objects, errors)
+        objects = [obj for _, obj in objects]
+
+        created = updated = unchanged = 0
+        try:
+            for start in range(0, len(objects), self.batch_size):
+                chunk = objects[start:start + self.batch_size]
+                with transaction.atomic(using=self.db):
+                    chunk_created, chunk_updated, chunk_unchanged = self.write_chunk(chunk)
+                created += chunk_created
+                updated += chunk_updated
+                unchanged += chunk_unchanged
+        finally:
+            if created or updated:
+                # bulk_create/bulk_update send no signals, so cached responses
+                # of the tenant are invalidated here
+                bump_generation(tenant_scope(self.tenant.id))
+
+        errors.sort(key=lambda error: error['index'])
+        return {'created': created, 'updated': updated, 'unchanged': unchanged, 'errors': errors}
+
+    def owned_parents(self, parent_ids):
+        if not parent_ids:
+            return set()
+        return set(
+            self.parent_model.objects.using(self.db).filter(
+                id__in=parent_ids, tenant=self.tenant, **self.parent_filter
+            ).values_list('id', flat=True)
+        )
+
+    def build(self, data):
+        data = dict(data)
+        parent_id = data.pop(self.parent_field)
+        return self.model(tenant_id=self.tenant.id, **{f'{self.parent_field}_id': parent_id}, **data)
+
+    def key(self, obj):
+        return getattr(obj, f'{self.parent_field}_id'), getattr(obj, self.natural_key)
+
+    def drop_duplicates(self, objects, errors):
+        """Keeps the last of the (index, object) pairs with the same key, reports the others in `errors`."""
+        by_key = {}
+        for index, obj in objects:
+            key = self.key(obj)
+            if key in by_key:
+                errors.append({
+                    'index': by_key[key][0],
+                    'errors': {self.natural_key: [f"Duplicate key in the request, superseded by row {index}."]},
+                })
+            by_key[key] = (index, obj)
+        return sorted(by_key.values(), key=lambda pair: pair[0])
+
+    def write_chunk(self, objects):
+        """Writes one chunk, returns the numbers of created, updated and unchanged rows."""
+        # bulk_create sends no signals, the counters are updated here
+        if not self.upsert:
+            objects_created(self.model.objects.using(self.db).bulk_create(objects), self.db)
+            return len(objects), 0, 0
+
+        # Keys are unique within the request, see drop_duplicates
+        by_key = {self.key(obj): obj for obj in objects}
+        existing = self.model.objects.using(self.db).filter(
+            tenant=self.tenant,
+            **{
+                f'{self.parent_field}_id__in': {parent_id for parent_id, _ in by_key},
+                f'{self.natural_key}__in': {value for _, value in by_key},
+            },
+        ).values_list('id', f'{self.parent_field}_id', self.natural_key)
+
+        to_update = []
+        for pk, parent_id, value in existing:
+            obj = by_key.pop((parent_id, value), None)
+            if obj is not None:
+                obj.pk = pk
+                to_update.append(obj)
+
+        to_create = list(by_key.values())
+        objects_created(self.model.objects.using(self.db).bulk_create(to_create), self.db)
+        if not self.update_fields:
+            # Nothing to write for rows that exist already
+            return len(to_create), 0, len(to_update)
+        if to_update:
+            for obj in to_update:
+                obj.version = F('version') + 1
+            self.model.objects.using(self.db).bulk_update(to_update, [*self.update_fields, 'version'])
+        return len(to_create), len(to_update), 0
+
+
+class DepartmentBulkWriter(BulkWriter):
+    model = Department
+    serializer_class = DepartmentBulkSerializer
+    parent_field = 'organization'
+    parent_model = Organization
+    parent_filter = {'deleted_at__isnull': True}
+    natural_key = 'name'
+
+
+class CustomerBulkWriter(BulkWriter):
+    model = Customer
+    serializer_class = CustomerBulkSerializer
+    parent_field = 'department'
+    parent_model = Department
+    parent_filter = {'organization__deleted_at__isnull': True}
+    natural_key = 'email'
+    update_fields = ['first_name', 'last_name']
+
+    def write_chunk(self, objects):
+        created, updated, unchanged = super().write_chunk(objects)
+        # bulk_create/bulk_update skip the post_save indexing
+        index_customers(objects, using=self.db, replace=bool(updated))
+        return created, updated, unchanged
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from tenants.models import Tenant
+
+logger = logging.getLogger('tenants.cache')
+
+_MISSING = object()
+_NOT_FOUND = '__tenant_not_found__'
+
+
+class TenantCache:
+    '''
+    Domain -> Tenant cache used by TenantMiddleware.
+
+    First tier is a bounded LRU kept in the worker process, second (optional)
+    tier is a shared Django cache, so workers do not all go to the database
+    after an invalidation. Unknown domains are cached too (with a shorter TTL).
+    The hit/miss counters are logged every `stats_interval` seconds.
+    '''
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=30, shared_alias=None, stats_interval=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.shared_alias = shared_alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stats_interval = stats_interval
+        self._stats_logged_at = time.monotonic()
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'TENANT_CACHE', {})
+        return cls(
+            max_size=options.get('MAX_SIZE', 1024),
+            ttl=options.get('TTL', 300),
+            negative_ttl=options.get('NEGATIVE_TTL', 30),
+            shared_alias=options.get('SHARED_CACHE_ALIAS'),
+            stats_interval=options.get('STATS_INTERVAL', 60),
+        )
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def _shared_key(self, domain):
+        return f'tenant:domain:{domain}'
+
+    def get(self, domain):
+        """Returns the tenant for the domain or None if there is no such tenant."""
+        value = self._get_local(domain)
+        if value is _MISSING:
+            value = self._get_shared(domain)
+            if value is _MISSING:
+                with self._lock:
+                    self.misses += 1
+                value = Tenant.objects.filter(domain=domain, deleted_at__isnull=True).first()
+                self._set_shared(domain, value)
+            self._set_local(domain, value)
+        self._log_stats()
+        return value
+
+    async def aget(self, domain):
+        """Async version of `get`, the local tier is read without leaving the event loop."""
+        value = self._get_local(domain)
+        if value is _MISSING:
+            value = await self._aget_shared(domain)
+            if value is _MISSING:
+                with self._lock:
+                    self.misses += 1
+                value = await Tenant.objects.filter(domain=domain, deleted_at__isnull=True).afirst()
+                await self._aset_shared(domain, value)
+            self._set_local(domain, value)
+        self._log_stats()
+        return value
+
+    def _get_local(self, domain):
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[domain]
+                return _MISSING
+            self._entries.move_to_end(domain)
+            self.hits += 1
+            return value
+
+    def _set_local(self, domain, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._entries[domain] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, domain):
+        if self.shared is None:
+            return _MISSING
+        value = self.shared.get(self._shared_key(domain), _MISSING)
+        if value is _MISSING:
+            return _MISSING
+        with self._lock:
+            self.shared_hits += 1
+        return None if value == _NOT_FOUND else value
+
+    def _set_shared(self, domain, value):
+        if self.shared is None:
+            return
+        if value is None:
+            self.shared.set(self._shared_key(domain), _NOT_FOUND, self.negative_ttl)
+        else:
+            self.shared.set(self._shared_key(domain), value, self.ttl)
+
+    async def _aget_shared(self, domain):
+        if self.shared is None:
+            return _MISSING
+        value = await self.shared.aget(self._shared_key(domain), _MISSING)
+        if value is _MISSING:
+            return _MISSING
+        with self._lock:
+            self.shared_hits += 1
+        return None if value == _NOT_FOUND else value
+
+    async def _aset_shared(self, domain, value):
+        if self.shared is None:
+            return
+        if value is None:
+            await self.shared.aset(self._shared_key(domain), _NOT_FOUND, self.negative_ttl)
+        else:
+            await self.shared.aset(self._shared_key(domain), value, self.ttl)
+
+    def invalidate(self, *domains):
+        """Drops the given domains from both tiers."""
+        domains = [domain for domain in domains if domain]
+        with self._lock:
+            for domain in domains:
+                self._entries.pop(domain, None)
+        if self.shared is not None and domains:
+            self.shared.delete_many([self._shared_key(domain) for domain in domains])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def _log_stats(self):
+        if not self.stats_interval:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._stats_logged_at < self.stats_interval:
+                return
+            self._stats_logged_at = now
+        logger.info("Tenant cache stats", extra=self.stats())
+
+    def stats(self):
+        """Returns hit/miss counters of this worker."""
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+
+tenant_cache = TenantCache.from_settings()
+
+
+def _generation_key(name):
+    return f'generation:{name}'
+
+
+def get_generation(name):
+    """Returns the current value of a named generation counter kept in the default cache."""
+    key = _generation_key(name)
+    generation = cache.get(key)
+    if generation is None:
+        # Seeded from the clock, so a counter evicted from the cache never
+        # comes back with a value that was already used.
+        cache.add(key, time.time_ns(), None)
+        generation = cache.get(key)
+    return generation
+
+
+async def aget_generation(name):
+    """Async version of `get_generation`."""
+    key = _generation_key(name)
+    generation = await cache.aget(key)
+    if generation is None:
+        await cache.aadd(key, time.time_ns(), None)
+        generation = await cache.aget(key)
+    return generation
+
+
+def bump_generation(name):
+    """Moves a named generation counter forward, orphaning everything keyed by the old value."""
+    key = _generation_key(name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = time.time_ns()
+        cache.set(key, generation, None)
+        return generation
+
+
+TENANTS_SCOPE = 'tenants'
+
+
+def tenant_scope(tenant_id):
+    """Name of the generation counter covering the data of one tenant."""
+    return f'tenant:{tenant_id}'
@@ -0,0 +1,216 @@
+from collections import Counter, defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import router, transaction
+from django.db.models import BigIntegerField, Case, Count, F, Q, Value, When
+
+from .models import Organization, Department, Customer, TenantCounter
+
+TENANT, ORGANIZATION, DEPARTMENT = TenantCounter.TENANT, TenantCounter.ORGANIZATION, TenantCounter.DEPARTMENT
+COUNTER_FIELDS = ('organizations', 'departments', 'customers')
+# Counter level of the objects having their own row, and the field counting them
+OWN_LEVEL = {Organization: ORGANIZATION, Department: DEPARTMENT}
+COUNTED_AS = {Organization: 'organizations', Department: 'departments', Customer: 'customers'}
+
+
+def _keys_filter(keys):
+    return reduce(or_, [Q(level=level, object_id=object_id) for level, object_id in keys])
+
+
+def create_rows(using, tenant_id, keys):
+    TenantCounter.objects.using(using).bulk_create(
+        [TenantCounter(tenant_id=tenant_id, level=level, object_id=object_id) for level, object_id in keys],
+        ignore_conflicts=True,
+    )
+
+
+def add(using, tenant_id, deltas):
+    """
+    Adds {(level, object_id): {field: delta}} to the counter rows of a tenant
+    with one UPDATE. Rows missing (e.g. of objects created without the
+    counters) are created with zeros first; `reconcile` fixes their values.
+    """
+    deltas = {key: {field: delta for field, delta in fields.items() if delta} for key, fields in deltas.items()}
+    deltas = {key: fields for key, fields in deltas.items() if fields}
+    if not deltas:
+        return
+    rows = TenantCounter.objects.using(using).filter(tenant_id=tenant_id)
+
+    def update(keys):
+        changes = {}
+        for field in COUNTER_FIELDS:
+            whens = [
+                When(level=level, object_id=object_id, then=Value(deltas[(level, object_id)][field]))
+                for level, object_id in keys if field in deltas[(level, object_id)]
+            ]
+            if whens:
+                changes[field] = F(field) + Case(*whens, default=Value(0), output_field=BigIntegerField())
+        return rows.filter(_keys_filter(keys)).update(**changes)
+
+    keys = list(deltas)
+    if update(keys) < len(keys):
+        existing = set(rows.filter(_keys_filter(keys)).values_list('level', 'object_id'))
+        missing = [key for key in keys if key not in existing]
+        create_rows(using, tenant_id, missing)
+        update(missing)
+
+
+def _organizations_of(customers, using):
+    """Department id -> organization id for the customers, from cached departments or one query."""
+    field = Customer._meta.get_field('department')
+    organizations = {
+        customer.department_id: customer.department.organization_id
+        for customer in customers if field.is_cached(customer)
+    }
+    missing = {customer.department_id for customer in customers} - organizations.keys()
+    if missing:
+        organizations.update(Department.objects.using(using).filter(id__in=missing).values_list('id', 'organization_id'))
+    return organizations
+
+
+def ancestors(instance, organizations=None, tenant_id=None, parent_id=None):
+    """
+    Counter keys above a hierarchy object, from the tenant down to its parent.
+    `tenant_id`/`parent_id` override the current values (previous parent of a move).
+    """
+    tenant_id = instance.tenant_id if tenant_id is None else tenant_id
+    keys = [(TENANT, tenant_id)]
+    if isinstance(instance, Department):
+        keys.append((ORGANIZATION, parent_id or instance.organization_id))
+    elif isinstance(instance, Customer):
+        department_id = parent_id or instance.department_id
+        keys += [(ORGANIZATION, organizations[department_id]), (DEPARTMENT, department_id)]
+    return keys
+
+
+def subtree(instance, using, tenant_id=None):
+    """Counts an object adds to its ancestors: itself and, from its own row, its descendants."""
+    counts = {COUNTED_AS[type(instance)]: 1}
+    level = OWN_LEVEL.get(type(instance))
+    if level:
+        row = TenantCounter.objects.using(using).filter(
+            tenant_id=instance.tenant_id if tenant_id is None else tenant_id, level=level, object_id=instance.pk,
+        ).values('departments', 'customers').first() or {}
+        for field in ('departments', 'customers'):
+            counts[field] = counts.get(field, 0) + row.get(field, 0)
+    return counts
+
+
+def objects_created(objects, using):
+    """Creates the rows of new organizations/departments and counts the objects in their ancestors."""
+    objects = [obj for obj in objects if obj.pk is not None]
+    if not objects:
+        return
+    organizations = _organizations_of(objects, using) if isinstance(objects[0], Customer) else None
+    rows = defaultdict(list)
+    deltas = defaultdict(lambda: defaultdict(Counter))
+    for obj in objects:
+        level = OWN_LEVEL.get(type(obj))
+        if level:
+            rows[obj.tenant_id].append((level, obj.pk))
+        for key in ancestors(obj, organizations):
+            deltas[obj.tenant_id][key][COUNTED_AS[type(obj)]] += 1
+    for tenant_id, keys in rows.items():
+        create_rows(using, tenant_id, keys)
+    for tenant_id, tenant_deltas in deltas.items():
+        add(using, tenant_id, tenant_deltas)
+
+
+def object_moved(instance, using):
+    """Moves the counts of an object whose parent (or tenant) changed from the old ancestors to the new."""
+    previous_tenant = getattr(instance, '_loaded_tenant_id', None)
+    previous_parent = getattr(instance, '_loaded_parent_id', None) if instance.parent_field else None
+    current_parent = getattr(instance, f'{instance.parent_field}_id') if instance.parent_field else None
+    if previous_tenant is None or (previous_tenant, previous_parent) == (instance.tenant_id, current_parent):
+        return
+    counts = subtree(instance, using, tenant_id=previous_tenant)
+    organizations = None
+    if isinstance(instance, Customer):
+        organizations = dict(Department.objects.using(using).filter(
+            id__in={previous_parent, current_parent}
+        ).values_list('id', 'organization_id'))
+    old = ancestors(instance, organizations, tenant_id=previous_tenant, parent_id=previous_parent)
+    add(using, previous_tenant, {key: {field: -value for field, value in counts.items()} for key in old})
+    add(using, instance.tenant_id, {key: counts for key in ancestors(instance, organizations)})
+
+
+def object_deleted(instance, using, counts=None):
+    """
+    Removes an object with its descendants from the counters of its ancestors
+    and deletes its own rows. Called only for the object a delete started
+    from: its cascaded descendants are covered by its counts, taken from its
+    own row unless given as `counts`.
+    """
+    counts = subtree(instance, using) if counts is None else counts
+    organizations = _organizations_of([instance], using) if isinstance(instance, Customer) else None
+    add(using, instance.tenant_id, {
+        key: {field: -value for field, value in counts.items()} for key in ancestors(instance, organizations)
+    })
+    rows = TenantCounter.objects.using(using).filter(tenant_id=instance.tenant_id)
+    if isinstance(instance, Organization):
+        rows.filter(
+            Q(level=ORGANIZATION, object_id=instance.pk)
+            | Q(level=DEPARTMENT, object_id__in=Department.objects.using(using).filter(organization=instance).values('id'))
+        ).delete()
+    elif isinstance(instance, Department):
+        rows.filter(level=DEPARTMENT, object_id=instance.pk).delete()
+
+
+def expected_counters(tenant_id, using):
+    """
+    {(level, object_id): {field: count}} of a tenant computed from its rows,
+    with two queries. Organizations waiting for their purge are not counted.
+    """
+    organization_ids = Organization.objects.using(using).filter(
+        tenant_id=tenant_id, deleted_at__isnull=True,
+    ).values_list('id', flat=True)
+    departments = Department.objects.using(using).filter(
+        tenant_id=tenant_id, organization__deleted_at__isnull=True,
+    ).values('id', 'organization_id').annotate(
+        customers=Count('customers'),
+    ).order_by()
+
+    zeros = dict.fromkeys(COUNTER_FIELDS, 0)
+    tenant = {**zeros}
+    counters = {(TENANT, tenant_id): tenant}
+    for organization_id in organization_ids:
+        counters[(ORGANIZATION, organization_id)] = {**zeros}
+        tenant['organizations'] += 1
+    for department in departments:
+        counters[(DEPARTMENT, department['id'])] = {**zeros, 'customers': department['customers']}
+        organization = counters.setdefault((ORGANIZATION, department['organization_id']), {**zeros})
+        for counts in (organization, tenant):
+            counts['departments'] += 1
+            counts['customers'] += department['customers']
+    return counters
+
+
+def reconcile(tenant, using=None):
+    """
+    Recomputes the counters of a tenant and fixes the rows that drifted.
+    The rows are locked first, so concurrent updates wait instead of being
+    overwritten. Returns the number of created, updated and deleted rows.
+    """
+    using = using or router.db_for_write(TenantCounter, instance=tenant)
+    with transaction.atomic(using=using):
+        rows = TenantCounter.objects.using(using).filter(tenant=tenant)
+        existing = {(row.level, row.object_id): row for row in rows.select_for_update()}
+        expected = expected_counters(tenant.id, using)
+
+        stale = [row.pk for key, row in existing.items() if key not in expected]
+        changed = []
+        for key, counts in expected.items():
+            row = existing.get(key)
+            if row is not None and any(getattr(row, field) != value for field, value in counts.items()):
+                for field, value in counts.items():
+                    setattr(row, field, value)
+                changed.append(row)
+        missing = [
+            TenantCounter(tenant=tenant, level=level, object_id=object_id, **counts)
+            for (level, object_id), counts in expected.items() if (level, object_id) not in existing
+        ]
+        rows.filter(pk__in=stale).delete()
+        TenantCounter.objects.using(using).bulk_update(changed, COUNTER_FIELDS, batch_size=1000)
+        TenantCounter.objects.using(using).bulk_create(missing, batch_size=1000)
+    return {'created': len(missing), 'updated': len(changed), 'deleted': len(stale)}
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryTracker:
+    '''
+    `connection.execute_wrapper` callable counting queries, their total time
+    and how many times each SQL shape was executed. Parameters are not part of
+    the SQL string, so repeated shapes are what an N+1 pattern looks like.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.shapes[sql] += 1
+
+    def repeated(self, threshold):
+        """Returns (sql, count) pairs of shapes executed at least `threshold` times."""
+        return [(sql, count) for sql, count in self.shapes.most_common() if count >= threshold]
+
+
+class QueryRecorder:
+    '''`connection.execute_wrapper` callable keeping the SELECTs it sees with their parameters.'''
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and sql.lstrip()[:6].upper() == 'SELECT':
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+def explain(connection, sql, params):
+    """Plan of a query as text, from EXPLAIN (EXPLAIN QUERY PLAN on SQLite)."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+        return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+
+class QueryStatsAggregator:
+    '''
+    Per view aggregates of the tracked requests. They are collected in memory
+    and written to QueryStat at most every `flush_interval` seconds, so the
+    bookkeeping does not add queries to every request.
+    '''
+
+    def __init__(self, flush_interval=30):
+        self.flush_interval = flush_interval
+        self._pending = defaultdict(lambda: {
+            'requests': 0, 'queries': 0, 'db_time': 0.0, 'max_queries': 0,
+            'budget_violations': 0, 'n_plus_one': 0,
+        })
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, view, tracker, over_budget, n_plus_one):
+        with self._lock:
+            stats = self._pending[view]
+            stats['requests'] += 1
+            stats['queries'] += tracker.count
+            stats['db_time'] += tracker.duration
+            stats['max_queries'] = max(stats['max_queries'], tracker.count)
+            stats['budget_violations'] += int(over_budget)
+            stats['n_plus_one'] += int(n_plus_one)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        from tenants.models import QueryStat
+
+        with self._lock:
+            pending = dict(self._pending)
+            self._pending.clear()
+            self._last_flush = time.monotonic()
+        for view, stats in pending.items():
+            QueryStat.objects.get_or_create(view=view)
+            QueryStat.objects.filter(view=view).update(
+                requests=F('requests') + stats['requests'],
+                queries=F('queries') + stats['queries'],
+                db_time=F('db_time') + stats['db_time'],
+                max_queries=Greatest('max_queries', stats['max_queries']),
+                budget_violations=F('budget_violations') + stats['budget_violations'],
+                n_plus_one=F('n_plus_one') + stats['n_plus_one'],
+            )
@@ -0,0 +1,111 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+_request_context = contextvars.ContextVar('request_context', default=None)
+
+CONTEXT_FIELDS = ('tenant', 'user', 'view')
+# Attributes every LogRecord has, everything else was passed with `extra=`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+def start_request_context():
+    """Starts an empty logging context for the current request, returns a token for `end_request_context`."""
+    return _request_context.set({})
+
+
+def end_request_context(token):
+    _request_context.reset(token)
+
+
+def bind_request_context(**values):
+    """Adds values (tenant, user, view) to the logging context of the current request."""
+    context = _request_context.get()
+    if context is not None:
+        context.update(values)
+
+
+class RequestContextFilter(logging.Filter):
+    '''Adds tenant, user and view of the current request to every record.'''
+
+    def filter(self, record):
+        context = _request_context.get() or {}
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, context.get(field))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    '''Lets through only a `rate` fraction of DEBUG records, other levels always pass.'''
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class StructuredFormatter(logging.Formatter):
+    '''Formats records as one JSON object per line, including fields passed with `extra=`.'''
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class QueueListenerHandler(QueueHandler):
+    '''
+    Non-blocking handler: records are put on a bounded queue and written to
+    `stream` by a background QueueListener thread. The formatter set on this
+    handler is used by the writer thread, so request threads only pay for
+    merging the message with its arguments. When the queue is full records
+    are dropped and counted instead of blocking the request.
+    '''
+
+    def __init__(self, stream=None, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
@@ -0,0 +1,72 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from tenants.models import Tenant, Organization, Department, Customer
+from tenants.renderers import ORJSONRenderer
+from tenants.serializers import CustomerSerializer, values_fields
+
+
+class Command(BaseCommand):
+    help = ("Compares rendering customers with CustomerSerializer + JSONRenderer and with "
+            ".values() + ORJSONRenderer. Rows are created in a transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per size, the best one is reported.")
+
+    def handle(self, *args, **options):
+        results = []
+        with transaction.atomic():
+            tenant = Tenant.objects.create(domain='bench-serializers', name='Benchmark')
+            organization = Organization.objects.create(tenant=tenant, name='Benchmark')
+            department = Department.objects.create(organization=organization, name='Benchmark')
+            created = 0
+            for size in sorted(options['sizes']):
+                Customer.objects.bulk_create(
+                    Customer(
+                        tenant_id=tenant.id, department=department,
+                        first_name=f'Żaneta {i}', last_name='Kowalska', email=f'customer{i}@example.com',
+                    )
+                    for i in range(created, size)
+                )
+                created = max(created, size)
+                queryset = Customer.objects.filter(department=department).order_by('id')[:size]
+                results.append(self.measure(queryset, size, options['repeat']))
+            transaction.set_rollback(True)
+
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def measure(self, queryset, size, repeat):
+        fields = values_fields(CustomerSerializer)
+
+        def serializer():
+            return JSONRenderer().render(CustomerSerializer(queryset, many=True).data)
+
+        def values():
+            rows = [{key: row[lookup] for key, lookup in fields} for row in queryset.values(*[lookup for _, lookup in fields])]
+            return ORJSONRenderer().render(rows)
+
+        timings = {}
+        output = {}
+        for name, render in (('serializer', serializer), ('values', values)):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                output[name] = render()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+
+        if output['serializer'] != output['values']:
+            raise CommandError(f"Outputs differ at {size} rows.")
+        return {
+            'rows': size,
+            'serializer_ms': round(1000 * timings['serializer'], 1),
+            'values_ms': round(1000 * timings['values'], 1),
+            'speedup': round(timings['serializer'] / timings['values'], 1),
+            'identical': True,
+        }
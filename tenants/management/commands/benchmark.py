@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from tenants import benchmark
+
+
+class Command(BaseCommand):
+    help = "Measures throughput and p50/p95/p99 latency of an API endpoint for an existing tenant."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--domain', required=True, help="Tenant domain (subdomain) to send requests for.")
+        parser.add_argument('--token', required=True, help="API token of a user with access to the endpoint.")
+        parser.add_argument('--path', default='/api/organizations/')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument('--url', help="Base URL of a running server, e.g. http://127.0.0.1:8000. "
+                                          "Without it requests go through the Django test client in process.")
+
+    def handle(self, *args, **options):
+        if options['url']:
+            driver = benchmark.HttpDriver(options['url'], options['domain'], options['token'])
+        else:
+            driver = benchmark.TestClientDriver(options['domain'], options['token'])
+
+        result = benchmark.run(
+            driver, options['path'],
+            requests=options['requests'], concurrency=options['concurrency'], warmup=options['warmup'],
+        )
+        self.stdout.write(json.dumps({'path': options['path'], **result}, indent=2))
@@ -0,0 +1,91 @@
+import json
+import platform
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import router
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from tenants import benchmark, seeding
+from tenants.models import Organization, Department, Customer
+
+
+class Command(BaseCommand):
+    help = ("Seeds tenants x organizations x departments x customers and measures throughput, "
+            "p50/p95/p99 latency and queries per request of every GET endpoint. Without --url the "
+            "data goes to a test database and requests through the Django test client.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tenants', type=int, default=3)
+        parser.add_argument('--organizations', type=int, default=5, help="Per tenant.")
+        parser.add_argument('--departments', type=int, default=5, help="Per organization.")
+        parser.add_argument('--customers', type=int, default=100, help="Per department.")
+        parser.add_argument('--requests', type=int, default=200, help="Per endpoint.")
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--no-response-cache', action='store_true',
+                            help="Measure the views instead of the per tenant response cache (in process only).")
+        parser.add_argument('--url', help="Base URL of a running server using the configured database, "
+                                          "e.g. http://127.0.0.1:8000. Seeded rows are deleted afterwards.")
+        parser.add_argument('--prefix', default='bench', help="Domain prefix of the seeded tenants.")
+        parser.add_argument('--output', help="Writes the results to this JSON file.")
+
+    def handle(self, *args, **options):
+        if options['url']:
+            try:
+                report = self.benchmark(options)
+            finally:
+                seeding.delete_seeded(options['prefix'])
+        else:
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                response_cache = {**getattr(settings, 'RESPONSE_CACHE', {})}
+                if options['no_response_cache']:
+                    response_cache['ENABLED'] = False
+                with override_settings(RESPONSE_CACHE=response_cache):
+                    report = self.benchmark(options)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def benchmark(self, options):
+        tenants = seeding.seed(
+            options['tenants'], options['organizations'], options['departments'], options['customers'],
+            prefix=options['prefix'],
+        )
+        token = seeding.create_api_user(f"{options['prefix']}-user")
+
+        tenant = tenants[0]
+        using = router.db_for_read(Organization, instance=tenant)
+        organization = Organization.objects.using(using).filter(tenant=tenant).order_by('id').first()
+        department = Department.objects.using(using).filter(organization=organization).order_by('id').first()
+        customer = Customer.objects.using(using).filter(department=department).order_by('id').first()
+        endpoints = benchmark.suite_endpoints(
+            organization.id if organization else 0,
+            department.id if department else 0,
+            customer.id if customer else 0,
+        )
+
+        if options['url']:
+            driver = benchmark.HttpDriver(options['url'], tenant.domain, token)
+        else:
+            driver = benchmark.TestClientDriver(tenant.domain, token)
+        results = benchmark.run_suite(
+            driver, endpoints,
+            requests=options['requests'], concurrency=options['concurrency'], warmup=options['warmup'],
+        )
+        return {
+            'driver': 'http' if options['url'] else 'test-client',
+            'python': platform.python_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'response_cache': not options['no_response_cache'],
+            'dataset': {key: options[key] for key in ('tenants', 'organizations', 'departments', 'customers')},
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'results': results,
+        }
@@ -0,0 +1,99 @@
+import re
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import Client
+from django.test.utils import override_settings
+
+from tenants.benchmark import suite_endpoints
+from tenants.instrumentation import QueryRecorder, explain
+from tenants.models import Tenant, Organization, Department, Customer
+
+# Postgres "Seq Scan on tenants_customer", SQLite "SCAN tenants_customer" (a
+# "SCAN ... USING INDEX" walks an index and is not reported).
+SEQUENTIAL_SCAN = re.compile(r'Seq Scan on (\w+)|\bSCAN (\w+)(?! USING)')
+# Endpoints listing every row of a table, a sequential scan is what they need
+FULL_SCANS = {'tenant-list'}
+
+
+def sequential_scans(plan):
+    return [table for match in SEQUENTIAL_SCAN.finditer(plan) for table in match.groups() if table]
+
+
+def record_queries(client, path, aliases):
+    """
+    Sends a GET request for `path`, returns the response and the (alias, sql,
+    params) of the SELECTs it ran. Only the first chunk of a streamed response
+    is read, which runs its query.
+    """
+    recorders = {alias: QueryRecorder() for alias in aliases}
+    with ExitStack() as stack:
+        for alias, recorder in recorders.items():
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        response = client.get(path)
+        if response.streaming:
+            next(iter(response.streaming_content), None)
+            response.close()
+    return response, [(alias, sql, params) for alias, recorder in recorders.items() for sql, params in recorder.queries]
+
+
+class Command(BaseCommand):
+    help = ("Sends the GET requests of the API for a tenant through the test client, runs EXPLAIN for "
+            "the queries the views run and fails if any of them scans a whole table.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--domain', help="Tenant domain to send the requests for, defaults to the first tenant.")
+        parser.add_argument('--token', required=True, help="API token of a user with access to the endpoints.")
+        parser.add_argument('--verbose-plans', action='store_true', help="Print every plan, not only the failing ones.")
+
+    def handle(self, *args, **options):
+        tenants = Tenant.objects.filter(deleted_at__isnull=True).order_by('id')
+        tenant = tenants.filter(domain=options['domain']).first() if options['domain'] else tenants.first()
+        if tenant is None:
+            raise CommandError("No tenant to send the requests for.")
+
+        organization = Organization.objects.using(tenant.shard).filter(tenant=tenant, deleted_at__isnull=True).order_by('id').first()
+        department = Department.objects.using(tenant.shard).filter(organization=organization).order_by('id').first()
+        customer = Customer.objects.using(tenant.shard).filter(department=department).order_by('id').first()
+        endpoints = suite_endpoints(
+            organization.id if organization else 0, department.id if department else 0, customer.id if customer else 0,
+        )
+
+        client = Client(HTTP_HOST=f'{tenant.domain}.localhost', HTTP_AUTHORIZATION=f"token {options['token']}")
+        aliases = sorted({DEFAULT_DB_ALIAS, tenant.shard})
+        recorded = []
+        # The views themselves, not the cached responses
+        with override_settings(RESPONSE_CACHE={**getattr(settings, 'RESPONSE_CACHE', {}), 'ENABLED': False}):
+            for name, path in endpoints:
+                # The first request caches the token, the permissions and the tenant
+                client.get(path)
+                response, queries = record_queries(client, path, aliases)
+                if response.status_code in (401, 403):
+                    raise CommandError(f"The token has no access to {path} ({response.status_code}).")
+                recorded.append((name, queries))
+
+        failures = []
+        with ExitStack() as stack:
+            for alias in aliases:
+                stack.enter_context(transaction.atomic(using=alias))
+                if connections[alias].vendor == 'postgresql':
+                    # On small tables the planner rightly prefers a sequential scan,
+                    # here we only want to know that a usable index exists.
+                    with connections[alias].cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+            for name, queries in recorded:
+                plans = [explain(connections[alias], sql, params) for alias, sql, params in queries]
+                scans = [] if name in FULL_SCANS else sorted({table for plan in plans for table in sequential_scans(plan)})
+                if scans:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(f"{name}: sequential scan of {', '.join(scans)}"))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f"{name}: index scan ({len(plans)} queries)"))
+                if scans or options['verbose_plans']:
+                    for (alias, sql, params), plan in zip(queries, plans):
+                        self.stdout.write(f"{sql}\n{plan}")
+
+        if failures:
+            raise CommandError(f"{len(failures)} endpoint{'' if len(failures) == 1 else 's'} without a usable index.")
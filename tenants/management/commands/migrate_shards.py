@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from tenants.sharding import reset_sequences
+
+
+class Command(BaseCommand):
+    help = ("Applies migrations to the default database and every tenant shard (replicas are skipped) "
+            "and points their id counters at their id ranges.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', nargs='?')
+        parser.add_argument('migration_name', nargs='?')
+
+    def handle(self, *args, **options):
+        targets = [name for name in (options['app_label'], options['migration_name']) if name]
+        replicas = {replica for aliases in getattr(settings, 'DATABASE_REPLICAS', {}).values() for replica in aliases}
+        for alias in settings.DATABASES:
+            if alias in replicas:
+                continue
+            self.stdout.write(f"Migrating '{alias}'")
+            call_command('migrate', *targets, database=alias, interactive=False, verbosity=options['verbosity'])
+            reset_sequences(alias)
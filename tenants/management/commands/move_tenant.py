@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tenants.models import Tenant
+from tenants.sharding import move_tenant
+
+
+class Command(BaseCommand):
+    help = ("Moves the organizations, departments and customers of a tenant to another database. "
+            "Rows keep their ids; the tenant should not be written to while it is moved.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('domain')
+        parser.add_argument('target', help="Database alias from DATABASES, e.g. 'shard1'.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--grace', type=int, help="Seconds to wait before deleting the source rows, "
+                                                      "defaults to TENANT_CACHE['TTL'].")
+
+    def handle(self, *args, **options):
+        tenant = Tenant.objects.filter(domain=options['domain']).first()
+        if tenant is None:
+            raise CommandError(f"Tenant '{options['domain']}' does not exist.")
+
+        try:
+            move_tenant(
+                tenant, options['target'],
+                batch_size=options['batch_size'], grace=options['grace'], log=self.stdout.write,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
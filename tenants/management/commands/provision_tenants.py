@@ -0,0 +1,32 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tenants.provisioning import FORMATS, Provisioner, load_parallel, read_spec, spec_format
+
+
+class Command(BaseCommand):
+    help = ("Creates tenants, organizations, departments and customers from a CSV, NDJSON or JSON spec "
+            "with bulk inserts. CSV/NDJSON rows have the columns: tenant, tenant_name, shard, organization, "
+            "department, first_name, last_name, email (one row per customer). JSON is a nested document: "
+            '{"tenants": [{"domain", "name", "organizations": [{"name", "departments": [{"name", "customers": [...]}]}]}]}.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows written per transaction.")
+        parser.add_argument('--workers', type=int, default=1, help="Processes to load tenants in parallel.")
+        parser.add_argument('--max-errors', type=int, default=100, help="Invalid rows listed in the report.")
+
+    def handle(self, *args, **options):
+        try:
+            spec_format(options['path'], options['format'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        rows = read_spec(options['path'], options['format'])
+        if options['workers'] > 1:
+            report = load_parallel(rows, options['workers'], options['batch_size'], options['max_errors'])
+        else:
+            report = Provisioner(options['batch_size'], options['max_errors']).load(rows)
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tenants.models import Tenant
+from tenants.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Recreates the customer search terms of one tenant, or of all tenants, on their shards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--domain', help="Only this tenant.")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        tenants = Tenant.objects.order_by('id')
+        if options['domain']:
+            tenants = tenants.filter(domain=options['domain'])
+            if not tenants.exists():
+                raise CommandError(f"Tenant '{options['domain']}' does not exist.")
+
+        for tenant in tenants:
+            count = rebuild_index(tenant, batch_size=options['batch_size'])
+            self.stdout.write(f"Indexed {count} customers of '{tenant.domain}' on '{tenant.shard}'.")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tenants.counters import reconcile
+from tenants.models import Tenant
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the organization, department and customer counters of one tenant, or of all "
+            "tenants, and fixes rows that drifted. Meant to be run periodically, e.g. from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--domain', help="Only this tenant.")
+
+    def handle(self, *args, **options):
+        tenants = Tenant.objects.order_by('id')
+        if options['domain']:
+            tenants = tenants.filter(domain=options['domain'])
+            if not tenants.exists():
+                raise CommandError(f"Tenant '{options['domain']}' does not exist.")
+
+        for tenant in tenants:
+            fixed = reconcile(tenant)
+            if any(fixed.values()):
+                self.stdout.write(
+                    f"'{tenant.domain}': created {fixed['created']}, updated {fixed['updated']}, "
+                    f"deleted {fixed['deleted']} counter rows."
+                )
+            else:
+                self.stdout.write(f"'{tenant.domain}': counters are up to date.")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from tenants.purge import run_worker
+
+
+class Command(BaseCommand):
+    help = ("Runs the background deletions of tenants and organizations queued by the API, leaves first "
+            "and in bounded batches. Several workers can run side by side; interrupted jobs are resumed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help="Rows per DELETE, defaults to PURGE['BATCH_SIZE'].")
+        parser.add_argument('--poll-interval', type=float, help="Seconds between checks for new jobs.")
+        parser.add_argument('--once', action='store_true', help="Exit when no job is left.")
+
+    def handle(self, *args, **options):
+        finished = run_worker(
+            batch_size=options['batch_size'], poll_interval=options['poll_interval'],
+            once=options['once'], log=self.stdout.write,
+        )
+        self.stdout.write(f"Finished {finished} jobs.")
@@ -1,96 +1,287 @@
-import json
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
 from django.http import JsonResponse
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-from rest_framework import status
-from tenants.models import Tenant
+from tenants.authentication import CachedTokenAuthentication
+from tenants.cache import tenant_cache
+from tenants.instrumentation import QueryBudgetExceeded, QueryStatsAggregator, QueryTracker
+from tenants.log import bind_request_context, end_request_context, start_request_context
+from tenants.routers import activate_replica_reads, activate_shard, deactivate_replica_reads, deactivate_shard
 
 PUBLIC_PATHS = ['/api/token/', '/api/doc/', '/admin/']
 
-class TenantMiddleware:
+logger = logging.getLogger('tenants.middleware')
+request_logger = logging.getLogger('tenants.requests')
+
+class AsyncCapableMiddleware:
+    '''
+    Base for middlewares running natively in both modes: under ASGI
+    `__acall__` is used, so the chain does not hop between threads.
+    '''
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.handle(request)
 
-        if not any(request.path.startswith(public_path) for public_path in PUBLIC_PATHS):
-            try:
-                domain = self._extract_domain(request)
-                print(f"Extracted domain: {domain}")
-
-                if request.path.startswith('/api/tenants/'):
-                    self._handle_tenant_endpoint(request, domain)
-                else:
-                    tenant = self._attach_tenant_to_request(request, domain)
-                    if request.path.startswith('/api/organizations/'):
-                        self._add_tenant_to_body(request, tenant)
-            
-            except ValueError as e:
-                return JsonResponse({"detail": f"{e}"}, status=400)
-        return self.get_response(request)
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def __acall__(self, request):
+        raise NotImplementedError
+
+
+class RequestLogMiddleware(AsyncCapableMiddleware):
+    '''
+    Opens the logging context of a request (tenant, user and view are added
+    to it along the way) and logs one structured record per request.
+    '''
+
+    def handle(self, request):
+        token = start_request_context()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            self._log(request, response, start)
+            return response
+        finally:
+            end_request_context(token)
+
+    async def __acall__(self, request):
+        token = start_request_context()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+            self._log(request, response, start)
+            return response
+        finally:
+            end_request_context(token)
+
+    def _log(self, request, response, start):
+        if request_logger.isEnabledFor(logging.INFO):
+            request_logger.info(
+                "%s %s %s", request.method, request.path, response.status_code,
+                extra={
+                    'method': request.method,
+                    'path': request.path,
+                    'status': response.status_code,
+                    'duration_ms': round((time.perf_counter() - start) * 1000, 2),
+                },
+            )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is not None:
+            bind_request_context(view=match.view_name)
+
+
+class TenantMiddleware(AsyncCapableMiddleware):
+
+    def handle(self, request):
+        try:
+            domain = self._tenant_domain(request)
+            if domain is not None:
+                self._attach_tenant_to_request(request, tenant_cache.get(domain))
+        except ValueError as e:
+            return JsonResponse({"detail": f"{e}"}, status=400)
+        token = self._activate_shard(request)
+        try:
+            return self.get_response(request)
+        finally:
+            deactivate_shard(token)
+
+    async def __acall__(self, request):
+        try:
+            domain = self._tenant_domain(request)
+            if domain is not None:
+                self._attach_tenant_to_request(request, await tenant_cache.aget(domain))
+        except ValueError as e:
+            return JsonResponse({"detail": f"{e}"}, status=400)
+        token = self._activate_shard(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            deactivate_shard(token)
+
+    def _activate_shard(self, request):
+        """Routes the tenant's models to its shard for the rest of the request."""
+        tenant = getattr(request, 'tenant', None)
+        return activate_shard(tenant.shard if tenant is not None else None)
+
+    def _tenant_domain(self, request):
+        """Returns the domain whose tenant has to be attached, None if there is nothing to attach."""
+        if any(request.path.startswith(public_path) for public_path in PUBLIC_PATHS):
+            return None
+        domain = self._extract_domain(request)
+        logger.debug("Extracted domain: %s", domain)
+        if request.path.startswith('/api/tenants/'):
+            # TenantSerializer takes the domain of a new tenant from here
+            request.tenant_domain = domain
+            return None
+        return domain
 
     def _extract_domain(self, request):
         """Extracts the domain from the request host."""
         host = request.get_host().split(':')[0]
-        print(host)
         domain = host.split('.')[0].lower()
         return domain
 
-    def _handle_tenant_endpoint(self, request, domain):
-        """Handles setting the domain in the request body for tenant creation."""
-        if request.method == "POST":
-            try:
-                data = json.loads(request.body)
-                data["domain"] = domain
-                request._body = json.dumps(data).encode('utf-8')
-            except ValueError as e:
-                raise ValueError(f"Erorr during adding tenant to the request body.") from e
-            
-        
-    def _attach_tenant_to_request(self, request, domain):
-        """Attaches the tenant object to the request based on the domain."""
-        try:
-            tenant = Tenant.objects.get(domain=domain)
-            print(f"Tenant attached: {tenant}")
-            request.tenant = tenant
-            return tenant
-        except Tenant.DoesNotExist:
+    def _attach_tenant_to_request(self, request, tenant):
+        """Attaches the tenant object resolved for the domain to the request."""
+        if tenant is None:
             raise ValueError("Tenant not found for this domain.")
-            
-    def _add_tenant_to_body(self, request, tenant):
-        """Adds tenant ID to the request body for specific endpoints."""
-        if request.method in ['POST', 'PUT', 'PATCH']:
-            try:
-                data = json.loads(request.body)
-                data["tenant"] = tenant.id
-                request._body = json.dumps(data).encode('utf-8')
-                print(f"Added tenant_id to request body: {tenant.id}")
-            except (ValueError, TypeError) as e:
-                raise ValueError(f"Invalid request body: {e}")
-
+        request.tenant = tenant
+        bind_request_context(tenant=tenant.domain)
+        logger.debug("Tenant attached: %s", tenant.id)
+        return tenant
 
 
+class TokenAuthenticationMiddleware(AsyncCapableMiddleware):
 
-class TokenAuthenticationMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
+    def handle(self, request):
         if any(request.path.startswith(public_path) for public_path in PUBLIC_PATHS):
             return self.get_response(request)
-        # Próba uzyskania tokenu z nagłówka
-        token = request.headers.get('Authorization')
+        token = self._extract_token(request)
         if not token:
             return JsonResponse({'detail': 'Authorization token required.'}, status=401)
+        # Próba autentykacji, wynik jest potem używany ponownie przez DRF
+        try:
+            self._authenticate(request, CachedTokenAuthentication().authenticate_credentials(token))
+        except AuthenticationFailed:
+            return JsonResponse({'detail': 'Invalid token.'}, status=401)
+        return self.get_response(request)
 
-        # Usunięcie prefiksu "Bearer" (jeśli jest)
-        if token.startswith('token '):
-            token = token[6:]  # Usuwamy "Token " z początku (6 znaków
-        # Próba autentykacji za pomocą TokenAuthentication
+    async def __acall__(self, request):
+        if any(request.path.startswith(public_path) for public_path in PUBLIC_PATHS):
+            return await self.get_response(request)
+        token = self._extract_token(request)
+        if not token:
+            return JsonResponse({'detail': 'Authorization token required.'}, status=401)
         try:
-            user, _ = TokenAuthentication().authenticate_credentials(token)
-            request.user = user  # Ustawiamy użytkownika w obiekcie request
+            self._authenticate(request, await CachedTokenAuthentication().aauthenticate_credentials(token))
         except AuthenticationFailed:
             return JsonResponse({'detail': 'Invalid token.'}, status=401)
+        return await self.get_response(request)
+
+    def _extract_token(self, request):
+        # Próba uzyskania tokenu z nagłówka
+        token = request.headers.get('Authorization')
+        # Usunięcie prefiksu "Bearer" (jeśli jest)
+        if token and token.startswith('token '):
+            token = token[6:]  # Usuwamy "Token " z początku (6 znaków
+        return token
+
+    def _authenticate(self, request, credentials):
+        user, auth_token = credentials
+        request.user = user  # Ustawiamy użytkownika w obiekcie request
+        request.token_auth = (user, auth_token)
+        bind_request_context(user=user.pk)
+
+
+class ReplicaMiddleware(AsyncCapableMiddleware):
+    '''
+    Lets GET/HEAD/OPTIONS requests read from replicas (see ReplicaRouter).
+    A successful write pins the tenant and the user to the primary for
+    REPLICA_ROUTING['PIN_SECONDS'], so clients read their own writes and
+    the response cache is not filled from a replica that is behind.
+    '''
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'DATABASE_REPLICAS', None):
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        self.pin_seconds = getattr(settings, 'REPLICA_ROUTING', {}).get('PIN_SECONDS', 5)
+
+    def handle(self, request):
+        keys = self._pin_keys(request)
+        if request.method in self.safe_methods:
+            token = activate_replica_reads(not (keys and cache.get_many(keys)))
+            try:
+                return self.get_response(request)
+            finally:
+                deactivate_replica_reads(token)
+        response = self.get_response(request)
+        if keys and response.status_code < 400:
+            cache.set_many(dict.fromkeys(keys, True), self.pin_seconds)
+        return response
+
+    async def __acall__(self, request):
+        keys = self._pin_keys(request)
+        if request.method in self.safe_methods:
+            token = activate_replica_reads(not (keys and await cache.aget_many(keys)))
+            try:
+                return await self.get_response(request)
+            finally:
+                deactivate_replica_reads(token)
+        response = await self.get_response(request)
+        if keys and response.status_code < 400:
+            await cache.aset_many(dict.fromkeys(keys, True), self.pin_seconds)
+        return response
+
+    def _pin_keys(self, request):
+        keys = []
+        tenant = getattr(request, 'tenant', None)
+        if tenant is not None:
+            keys.append(f'replica:pin:tenant:{tenant.id}')
+        token_auth = getattr(request, 'token_auth', None)
+        if token_auth is not None:
+            keys.append(f'replica:pin:user:{token_auth[0].pk}')
+        return keys
+
+
+class QueryBudgetMiddleware:
+    '''
+    Counts queries and DB time of every request, detects repeated SQL shapes
+    (N+1) and checks the per view budgets from QUERY_BUDGET. Over budget
+    requests are logged, or fail when QUERY_BUDGET['RAISE'] is set (tests).
+    Aggregates per view are visible in the admin (Query stats).
+    It is a development tool and runs only in sync mode.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = getattr(settings, 'QUERY_BUDGET', {})
+        if not self.options.get('ENABLED', False):
+            raise MiddlewareNotUsed()
+        self.stats = QueryStatsAggregator(self.options.get('FLUSH_INTERVAL', 30))
+        self.logger = logging.getLogger('tenants.queries')
+
+    def __call__(self, request):
+        tracker = QueryTracker()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(tracker))
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        view_name = match.view_name if match and match.view_name else 'unresolved'
+        # A list URL serves both the list (GET) and the create (POST)
+        budget = self.options.get('VIEWS', {}).get((view_name, request.method), self.options.get('DEFAULT'))
+        view = f'{request.method} {view_name}'
+        over_budget = budget is not None and tracker.count > budget
+        repeated = tracker.repeated(self.options.get('N_PLUS_ONE_THRESHOLD', 5))
+        self.stats.record(view, tracker, over_budget, bool(repeated))
 
-        return self.get_response(request)
\ No newline at end of file
+        for sql, count in repeated:
+            self.logger.warning("Possible N+1 in %s: %d x %s", view, count, sql[:200])
+        if over_budget:
+            message = f"{view} ran {tracker.count} queries ({tracker.duration * 1000:.1f} ms), budget is {budget}."
+            if self.options.get('RAISE', False):
+                raise QueryBudgetExceeded(message)
+            self.logger.warning(message)
+        return response
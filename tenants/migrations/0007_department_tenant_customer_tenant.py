@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-17 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0006_alter_department_options_alter_tenant_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='tenant',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='customers', to='tenants.tenant'),
+        ),
+        migrations.AddField(
+            model_name='department',
+            name='tenant',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='departments', to='tenants.tenant'),
+        ),
+    ]
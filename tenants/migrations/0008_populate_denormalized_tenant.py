@@ -0,0 +1,31 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def populate_tenant(apps, schema_editor):
+    Organization = apps.get_model('tenants', 'Organization')
+    Department = apps.get_model('tenants', 'Department')
+    Customer = apps.get_model('tenants', 'Customer')
+    db = schema_editor.connection.alias
+
+    Department.objects.using(db).update(
+        tenant_id=Subquery(
+            Organization.objects.using(db).filter(pk=OuterRef('organization_id')).values('tenant_id')[:1]
+        )
+    )
+    Customer.objects.using(db).update(
+        tenant_id=Subquery(
+            Department.objects.using(db).filter(pk=OuterRef('department_id')).values('tenant_id')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0007_department_tenant_customer_tenant'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_tenant, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-17 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0008_populate_denormalized_tenant'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customer',
+            name='tenant',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='customers', to='tenants.tenant'),
+        ),
+        migrations.AlterField(
+            model_name='department',
+            name='tenant',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='departments', to='tenants.tenant'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0009_alter_customer_tenant_alter_department_tenant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(max_length=255, unique=True)),
+                ('requests', models.PositiveBigIntegerField(default=0)),
+                ('queries', models.PositiveBigIntegerField(default=0)),
+                ('db_time', models.FloatField(default=0.0)),
+                ('max_queries', models.PositiveIntegerField(default=0)),
+                ('budget_violations', models.PositiveBigIntegerField(default=0)),
+                ('n_plus_one', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0011_query_shape_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tenant',
+            name='shard',
+            field=models.CharField(default='default', editable=False, max_length=100),
+        ),
+    ]
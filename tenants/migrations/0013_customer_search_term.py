@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0012_tenant_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='tenants.customer')),
+                ('tenant', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='tenants.tenant')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tenant', 'term'], name='search_term_tenant_term_idx', opclasses=['', 'varchar_pattern_ops'])],
+            },
+        ),
+    ]
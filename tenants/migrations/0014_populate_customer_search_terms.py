@@ -0,0 +1,61 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+BATCH_SIZE = 2000
+
+# The tokenizer of tenants.search as of this migration, copied so later
+# changes to it do not change what this migration writes
+SEARCH_FIELDS = ('first_name', 'last_name', 'email')
+MAX_TERM_LENGTH = 64
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.replace('ł', 'l').replace('Ł', 'L'))
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def tokenize(text):
+    return [word[:MAX_TERM_LENGTH] for word in _WORD.findall(normalize(text or ''))]
+
+
+def customer_terms(first_name, last_name, email):
+    terms = set(tokenize(first_name)) | set(tokenize(last_name)) | set(tokenize(email))
+    if email:
+        terms.add(normalize(email)[:MAX_TERM_LENGTH])
+    return terms
+
+
+def populate_terms(apps, schema_editor):
+    Customer = apps.get_model('tenants', 'Customer')
+    CustomerSearchTerm = apps.get_model('tenants', 'CustomerSearchTerm')
+    db = schema_editor.connection.alias
+
+    terms = []
+    rows = Customer.objects.using(db).values_list('id', 'tenant_id', *SEARCH_FIELDS)
+    for customer_id, tenant_id, *values in rows.iterator(chunk_size=BATCH_SIZE):
+        terms.extend(
+            CustomerSearchTerm(tenant_id=tenant_id, customer_id=customer_id, term=term)
+            for term in customer_terms(*values)
+        )
+        if len(terms) >= BATCH_SIZE:
+            CustomerSearchTerm.objects.using(db).bulk_create(terms)
+            terms = []
+    CustomerSearchTerm.objects.using(db).bulk_create(terms)
+
+
+def delete_terms(apps, schema_editor):
+    apps.get_model('tenants', 'CustomerSearchTerm').objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0013_customer_search_term'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_terms, delete_terms),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0014_populate_customer_search_terms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TenantCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(choices=[('tenant', 'Tenant'), ('organization', 'Organization'), ('department', 'Department')], max_length=16)),
+                ('object_id', models.BigIntegerField()),
+                ('organizations', models.BigIntegerField(default=0)),
+                ('departments', models.BigIntegerField(default=0)),
+                ('customers', models.BigIntegerField(default=0)),
+                ('tenant', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='tenants.tenant')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('tenant', 'level', 'object_id'), name='counter_tenant_level_object_uniq')],
+            },
+        ),
+    ]
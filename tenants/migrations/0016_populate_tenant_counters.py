@@ -0,0 +1,44 @@
+from django.db import migrations
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    Tenant = apps.get_model('tenants', 'Tenant')
+    Organization = apps.get_model('tenants', 'Organization')
+    Department = apps.get_model('tenants', 'Department')
+    TenantCounter = apps.get_model('tenants', 'TenantCounter')
+    db = schema_editor.connection.alias
+
+    for tenant_id in Tenant.objects.using(db).values_list('id', flat=True).iterator():
+        zeros = {'organizations': 0, 'departments': 0, 'customers': 0}
+        counters = {('tenant', tenant_id): {**zeros}}
+        for organization_id in Organization.objects.using(db).filter(tenant_id=tenant_id).values_list('id', flat=True):
+            counters[('organization', organization_id)] = {**zeros}
+            counters[('tenant', tenant_id)]['organizations'] += 1
+        departments = Department.objects.using(db).filter(tenant_id=tenant_id).values('id', 'organization_id').annotate(
+            customers=Count('customers'),
+        ).order_by()
+        for department in departments:
+            counters[('department', department['id'])] = {**zeros, 'customers': department['customers']}
+            for key in (('organization', department['organization_id']), ('tenant', tenant_id)):
+                counters[key]['departments'] += 1
+                counters[key]['customers'] += department['customers']
+        TenantCounter.objects.using(db).bulk_create([
+            TenantCounter(tenant_id=tenant_id, level=level, object_id=object_id, **counts)
+            for (level, object_id), counts in counters.items()
+        ], batch_size=1000)
+
+
+def delete_counters(apps, schema_editor):
+    apps.get_model('tenants', 'TenantCounter').objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0015_tenant_counter'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_counters, delete_counters),
+    ]
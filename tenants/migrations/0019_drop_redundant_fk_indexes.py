@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0018_versions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customer',
+            name='department',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='customers', to='tenants.department'),
+        ),
+        migrations.AlterField(
+            model_name='department',
+            name='organization',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='departments', to='tenants.organization'),
+        ),
+    ]
@@ -0,0 +1,175 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+
+from .cache import get_generation, tenant_scope
+from .serializers import values_fields
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def if_none_match(request, etag):
+    """True if the If-None-Match header is '*' or names `etag`, compared weakly."""
+    values = parse_etags(request.headers.get('If-None-Match', ''))
+    return '*' in values or _strip_weak(etag) in {_strip_weak(value) for value in values}
+
+
+class TenantCachedResponseMixin:
+    '''
+    Caches the data of successful GET list/retrieve responses per tenant.
+
+    Keys contain the generation counter of the tenant (bumped by the model
+    signals and the bulk writers) and of the permission index, so a write
+    orphans every cached response of the tenant instead of expiring it. The
+    ETag is derived from the key, so a matching `If-None-Match` is answered
+    with 304 without reading the cache. Authentication and permission checks
+    still run for every request.
+    '''
+
+    def get_response_cache_scope(self):
+        """Name of the generation counter the cached responses depend on."""
+        return tenant_scope(self.request.tenant.id)
+
+    def get_response_cache_key(self, request):
+        params = urlencode(sorted(
+            (key, value) for key, values in request.query_params.lists() for value in values
+        ))
+        generation = get_generation(self.get_response_cache_scope())
+        permissions = get_generation('permissions')
+        fmt = getattr(request, 'accepted_renderer', None)
+        fmt = fmt.format if fmt else ''
+        digest = hashlib.sha256(f'{request.get_host()}{request.path}?{params}'.encode()).hexdigest()
+        # Pagination links contain the host, so it is part of the key as well
+        return f'response:{self.get_response_cache_scope()}:{generation}:{permissions}:{fmt}:{digest}'
+
+    def cached_response(self, request, handler, *args, **kwargs):
+        options = getattr(settings, 'RESPONSE_CACHE', {})
+        if not options.get('ENABLED', True):
+            return handler(request, *args, **kwargs)
+
+        key = self.get_response_cache_key(request)
+        etag = 'W/"%s"' % hashlib.sha256(key.encode()).hexdigest()[:32]
+        if if_none_match(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        data = cache.get(key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            cache.set(key, response.data, options.get('TTL', 300))
+        else:
+            response = Response(data)
+        response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, self.list_response, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, self.retrieve_response, *args, **kwargs)
+
+    def list_response(self, request, *args, **kwargs):
+        """Builds the list response on a cache miss, override this instead of `list`."""
+        return super().list(request, *args, **kwargs)
+
+    def retrieve_response(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+
+def version_etag(version):
+    return f'"{version}"'
+
+
+def if_match_versions(request):
+    """
+    Versions accepted by the If-Match header: None without the header or
+    with '*', else a set (empty when no entity tag can match). Weak entity
+    tags never match, If-Match uses the strong comparison.
+    """
+    header = request.headers.get('If-Match')
+    if header is None:
+        return None
+    values = [value.strip() for value in header.split(',')]
+    if '*' in values:
+        return None
+    return {int(value[1:-1]) for value in values if len(value) > 2 and value[0] == value[-1] == '"' and value[1:-1].isdigit()}
+
+
+class VersionedUpdateMixin:
+    '''
+    ETags and optimistic concurrency for detail views of versioned models.
+
+    Retrieve answers with the object's version as a strong ETag (304 for a
+    matching `If-None-Match`). Updates fetch the object once and write it
+    with one conditional UPDATE: a request whose `If-Match` does not name
+    the current version, or that lost a race with another write, gets 412.
+    Without `If-Match` the last write wins, as before.
+    '''
+
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        etag = version_etag(response.data['version'])
+        if if_none_match(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response['ETag'] = etag
+        return response
+
+    def validate_update(self, instance):
+        """Checks run on the fetched object before it is updated, e.g. ownership."""
+
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        instance = self.get_object()
+        self.validate_update(instance)
+        versions = if_match_versions(request)
+        if versions is not None and instance.version not in versions:
+            return self.precondition_failed(instance.version)
+
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        for attr, value in serializer.validated_data.items():
+            setattr(instance, attr, value)
+        if not instance.save_if_version(instance.version, serializer.validated_data.keys()):
+            current = type(instance)._base_manager.filter(pk=instance.pk).values_list('version', flat=True).first()
+            if current is None:
+                raise NotFound()
+            if versions is not None:
+                return self.precondition_failed(current)
+            instance.version = current
+            instance.save()
+        return Response(serializer.data, headers={'ETag': version_etag(instance.version)})
+
+    def precondition_failed(self, version):
+        return Response(
+            {"detail": "The object was modified since the version given in If-Match."},
+            status=status.HTTP_412_PRECONDITION_FAILED, headers={'ETag': version_etag(version)},
+        )
+
+
+class ValuesListMixin:
+    '''
+    Lists rows fetched with `.values()` and emits dicts directly instead of
+    running the ModelSerializer per row. The keys and values are the same as
+    the serializer's (see `values_fields`), pagination works on the dicts.
+    '''
+
+    def list(self, request, *args, **kwargs):
+        fields = values_fields(self.get_serializer_class())
+        queryset = self.filter_queryset(self.get_queryset()).values(*[lookup for _, lookup in fields])
+
+        page = self.paginate_queryset(queryset)
+        rows = [{key: row[lookup] for key, lookup in fields} for row in (queryset if page is None else page)]
+        if page is not None:
+            return self.get_paginated_response(rows)
+        return Response(rows)
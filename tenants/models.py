@@ -1,8 +1,120 @@
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models.signals import post_save, pre_save
 
-class Tenant(models.Model):
+
+class VersionedModel(models.Model):
+    """
+    Base for models with a `version` bumped by every update, used as their
+    ETag. `save_if_version` is the optimistic concurrency write of the API.
+    """
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            self.version += 1
+        super().save(*args, **kwargs)
+
+    def save_if_version(self, expected, update_fields):
+        """
+        Writes `update_fields` and the next version with one
+        UPDATE ... WHERE id = ? AND version = ?. Returns False, without
+        changes, when the row is no longer at the `expected` version.
+        pre_save/post_save are sent as by `save(update_fields=...)`.
+        """
+        using = router.db_for_write(type(self), instance=self)
+        update_fields = frozenset([*update_fields, 'version'])
+        with transaction.atomic(using=using, savepoint=False):
+            pre_save.send(sender=type(self), instance=self, raw=False, using=using, update_fields=update_fields)
+            values = {
+                field.attname: getattr(self, field.attname)
+                for field in map(self._meta.get_field, update_fields) if field.name != 'version'
+            }
+            if not type(self)._base_manager.using(using).filter(pk=self.pk, version=expected).update(version=expected + 1, **values):
+                return False
+            self.version = expected + 1
+            self._state.db = using
+            post_save.send(sender=type(self), instance=self, created=False, update_fields=update_fields, raw=False, using=using)
+        return True
+
+
+class TenantTrackingModel(VersionedModel):
+    """
+    Base for models carrying a tenant_id.
+
+    `parent_field` names the FK the tenant is denormalized from; the value is
+    refreshed on save only when the parent changes. Values loaded from the
+    database are remembered, so moves between tenants can be detected.
+    """
+    parent_field = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_tenant_id = instance.__dict__.get('tenant_id')
+        if cls.parent_field:
+            instance._loaded_parent_id = instance.__dict__.get(f'{cls.parent_field}_id')
+        return instance
+
+    def sync_tenant(self):
+        """Copies tenant_id from the parent, without loading it if it is already cached."""
+        field = self._meta.get_field(self.parent_field)
+        parent_id = getattr(self, field.attname)
+        if self.tenant_id is not None and parent_id == getattr(self, '_loaded_parent_id', None):
+            return
+        if field.is_cached(self):
+            self.tenant_id = getattr(self, self.parent_field).tenant_id
+        else:
+            self.tenant_id = field.related_model.objects.values_list('tenant_id', flat=True).get(pk=parent_id)
+
+    def tenant_changed(self):
+        loaded = getattr(self, '_loaded_tenant_id', None)
+        return loaded is not None and loaded != self.tenant_id
+
+    def save(self, *args, **kwargs):
+        if self.parent_field:
+            self.sync_tenant()
+        # The row, its post_save work (counters) and the propagation commit together
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(type(self), instance=self)):
+            super().save(*args, **kwargs)
+            if self.tenant_changed():
+                self.propagate_tenant()
+        self.remember_loaded()
+
+    def save_if_version(self, expected, update_fields):
+        update_fields = set(update_fields)
+        if self.parent_field:
+            self.sync_tenant()
+            update_fields.add('tenant')
+        with transaction.atomic(using=router.db_for_write(type(self), instance=self)):
+            if not super().save_if_version(expected, update_fields):
+                return False
+            if self.tenant_changed():
+                self.propagate_tenant()
+        self.remember_loaded()
+        return True
+
+    def remember_loaded(self):
+        self._loaded_tenant_id = self.tenant_id
+        if self.parent_field:
+            self._loaded_parent_id = getattr(self, f'{self.parent_field}_id')
+
+    def propagate_tenant(self):
+        """Updates the denormalized tenant of the children after a move."""
+
+
+class Tenant(VersionedModel):
     domain = models.CharField(max_length=255, unique=True)
     name = models.CharField(max_length=255)
+    # Database alias holding the tenant's organizations, departments and customers
+    shard = models.CharField(max_length=100, default='default', editable=False)
+    # Set when the tenant is scheduled for purging (see tenants.purge), it is hidden from then on
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'{self.name} {self.domain}'
@@ -12,39 +124,189 @@ class Tenant(models.Model):
             ('can_access_tenant', 'Can access tenant'),
         ]
 
-class Organization(models.Model):
+class Organization(TenantTrackingModel):
     tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name="organizations")
     name = models.CharField(max_length=255)
+    # Set when the organization is scheduled for purging, it is hidden from then on
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.name} ({self.tenant.name})"
 
+    def propagate_tenant(self):
+        Department.objects.filter(organization=self).update(tenant_id=self.tenant_id)
+        Customer.objects.filter(department__organization=self).update(tenant_id=self.tenant_id)
+        CustomerSearchTerm.objects.filter(customer__department__organization=self).update(tenant_id=self.tenant_id)
+        TenantCounter.objects.filter(
+            models.Q(level=TenantCounter.ORGANIZATION, object_id=self.pk)
+            | models.Q(level=TenantCounter.DEPARTMENT, object_id__in=Department.objects.filter(organization=self).values('id'))
+        ).update(tenant_id=self.tenant_id)
+
     class Meta:
         permissions = [
             ('can_access_organization', 'Can access organization'),
         ]
+        indexes = [
+            # Keyset listing of a tenant: WHERE tenant_id = ? ORDER BY id
+            models.Index(fields=['tenant', 'id'], name='organization_tenant_id_idx'),
+        ]
 
-class Department(models.Model):
-    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name="departments")
+class Department(TenantTrackingModel):
+    parent_field = 'organization'
+    # Indexed by department_org_id_idx, whose leading column it is
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name="departments", db_index=False)
+    # Denormalized from organization.tenant, so tenant checks need no joins
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name="departments", editable=False)
     name = models.CharField(max_length=255)
 
     def __str__(self):
         return f"{self.name} ({self.organization.name})"
 
+    def propagate_tenant(self):
+        Customer.objects.filter(department=self).update(tenant_id=self.tenant_id)
+        CustomerSearchTerm.objects.filter(customer__department=self).update(tenant_id=self.tenant_id)
+        TenantCounter.objects.filter(level=TenantCounter.DEPARTMENT, object_id=self.pk).update(tenant_id=self.tenant_id)
+
     class Meta:
         permissions = [
             ('can_access_department', 'Can access department'),
         ]
+        indexes = [
+            # Keyset listing of an organization: WHERE organization_id = ? ORDER BY id
+            models.Index(fields=['organization', 'id'], name='department_org_id_idx'),
+        ]
 
-class Customer(models.Model):
-    department = models.ForeignKey(Department, on_delete=models.CASCADE, related_name="customers")
+class Customer(TenantTrackingModel):
+    parent_field = 'department'
+    # Indexed by customer_department_id_idx, whose leading column it is
+    department = models.ForeignKey(Department, on_delete=models.CASCADE, related_name="customers", db_index=False)
+    # Denormalized from department.tenant, so tenant checks need no joins
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name="customers", editable=False)
     first_name = models.CharField(max_length=255)
     last_name = models.CharField(max_length=255)
     email = models.EmailField()
 
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.department.name})"
+
     class Meta:
         permissions = [
             ('can_access_customer', 'Can access customer'),
         ]
+        indexes = [
+            # Keyset listing of a department: WHERE department_id = ? ORDER BY id
+            models.Index(fields=['department', 'id'], name='customer_department_id_idx'),
+            # Export of a whole tenant: WHERE tenant_id = ? ORDER BY id
+            models.Index(fields=['tenant', 'id'], name='customer_tenant_id_idx'),
+            # Natural key used by the bulk upsert
+            models.Index(fields=['department', 'email'], name='customer_department_email_idx'),
+        ]
+
+class CustomerSearchTerm(models.Model):
+    """
+    Inverted index of customers: one row per normalized word of the name and
+    email (see tenants.search), maintained on save and by the bulk paths.
+    """
+    # Indexed only together with term (search_term_tenant_term_idx)
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='+', db_index=False)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=64)
+
+    def __str__(self):
+        return self.term
+
+    class Meta:
+        indexes = [
+            # Prefix lookups within a tenant: WHERE tenant_id = ? AND term LIKE 'abc%'
+            models.Index(fields=['tenant', 'term'], name='search_term_tenant_term_idx', opclasses=['', 'varchar_pattern_ops']),
+        ]
+
+class TenantCounter(models.Model):
+    """
+    Maintained number of organizations, departments and customers below a
+    tenant, an organization or a department (see tenants.counters). Rows live
+    on the tenant's shard and are reconciled by `reconcile_counters`.
+    """
+    TENANT = 'tenant'
+    ORGANIZATION = 'organization'
+    DEPARTMENT = 'department'
+    LEVELS = [(TENANT, 'Tenant'), (ORGANIZATION, 'Organization'), (DEPARTMENT, 'Department')]
+
+    # Indexed only as the first column of counter_tenant_level_object_uniq
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='+', db_index=False)
+    level = models.CharField(max_length=16, choices=LEVELS)
+    # Id of the tenant, organization or department, per level
+    object_id = models.BigIntegerField()
+    organizations = models.BigIntegerField(default=0)
+    departments = models.BigIntegerField(default=0)
+    customers = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.level} {self.object_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tenant', 'level', 'object_id'], name='counter_tenant_level_object_uniq'),
+        ]
+
+class PurgeJob(models.Model):
+    """
+    Background deletion of a tenant or an organization with everything below
+    it, run by `run_purge_worker`. Kept on the default database; ids are not
+    foreign keys, so the job outlives what it deletes.
+    """
+    TENANT = 'tenant'
+    ORGANIZATION = 'organization'
+    KINDS = [(TENANT, 'Tenant'), (ORGANIZATION, 'Organization')]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=16, choices=KINDS)
+    tenant_id = models.BigIntegerField()
+    object_id = models.BigIntegerField()
+    # Database holding the rows to delete (the tenant's shard)
+    shard = models.CharField(max_length=100)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    # Deleted rows per table
+    deleted = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Refreshed with every batch, a running job not updated for PURGE['LEASE'] seconds is taken over
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} ({self.status})"
+
+    class Meta:
+        indexes = [
+            # Claiming the next job: WHERE status IN (...) ORDER BY id
+            models.Index(fields=['status', 'id'], name='purge_job_status_id_idx'),
+        ]
+
+class QueryStat(models.Model):
+    """Per view query aggregates collected by QueryBudgetMiddleware."""
+    view = models.CharField(max_length=255, unique=True)
+    requests = models.PositiveBigIntegerField(default=0)
+    queries = models.PositiveBigIntegerField(default=0)
+    db_time = models.FloatField(default=0.0)
+    max_queries = models.PositiveIntegerField(default=0)
+    budget_violations = models.PositiveBigIntegerField(default=0)
+    n_plus_one = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.view
+
+    @property
+    def avg_queries(self):
+        return self.queries / self.requests if self.requests else 0
+
+    @property
+    def avg_db_time_ms(self):
+        return 1000 * self.db_time / self.requests if self.requests else 0
@@ -0,0 +1,51 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class TenantCursorPagination(CursorPagination):
+    '''
+    Keyset pagination on `id` for tenant scoped list endpoints.
+
+    Cursors are opaque, pages stay stable under concurrent inserts and
+    no COUNT(*) is executed.
+    '''
+    ordering = 'id'
+    page_size = getattr(settings, 'PAGINATION_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'PAGINATION_MAX_PAGE_SIZE', 1000)
+
+
+class SearchPagination(LimitOffsetPagination):
+    '''
+    Limit/offset pages of ranked search results.
+
+    Ranked results have no stable key to paginate on, so pages are
+    addressed by offset. No COUNT(*) is executed: one row past the limit
+    tells whether there is a next page.
+    '''
+    default_limit = getattr(settings, 'PAGINATION_PAGE_SIZE', 100)
+    max_limit = getattr(settings, 'PAGINATION_MAX_PAGE_SIZE', 1000)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
@@ -1,9 +1,76 @@
-from rest_framework.permissions import BasePermission
-from rest_framework.exceptions import PermissionDenied
+import logging
 
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.db.models import Q
 from rest_framework.permissions import BasePermission
 from rest_framework.exceptions import PermissionDenied
 
+from tenants.cache import aget_generation, get_generation
+
+logger = logging.getLogger('tenants.permissions')
+
+
+def _permission_index_key(generation, user):
+    return f"perm:index:{generation}:{user.pk}"
+
+
+def _permission_index_ttl():
+    return getattr(settings, 'PERMISSION_INDEX_TTL', 60)
+
+
+def _permission_rows(user):
+    permissions = Permission.objects.all()
+    if not user.is_superuser:
+        permissions = permissions.filter(Q(user=user) | Q(group__user=user))
+    return permissions.values_list('content_type__app_label', 'codename').distinct()
+
+
+def get_permission_index(user):
+    '''
+    Returns a frozenset of 'app_label.codename' permissions of the user,
+    granted directly or through groups.
+
+    The set is built with one query and kept in the cache under the current
+    'permissions' generation, which is bumped whenever permission
+    assignments change, for at most PERMISSION_INDEX_TTL seconds. It is
+    also memoized on the user object.
+    '''
+    index = getattr(user, '_permission_index', None)
+    if index is not None:
+        return index
+
+    cache_key = _permission_index_key(get_generation('permissions'), user)
+    index = cache.get(cache_key)
+    if index is None:
+        index = frozenset(f'{app_label}.{codename}' for app_label, codename in _permission_rows(user))
+        cache.set(cache_key, index, _permission_index_ttl())
+    user._permission_index = index
+    return index
+
+
+async def aget_permission_index(user):
+    """Async version of `get_permission_index`."""
+    index = getattr(user, '_permission_index', None)
+    if index is not None:
+        return index
+
+    cache_key = _permission_index_key(await aget_generation('permissions'), user)
+    index = await cache.aget(cache_key)
+    if index is None:
+        index = frozenset([f'{app_label}.{codename}' async for app_label, codename in _permission_rows(user)])
+        await cache.aset(cache_key, index, _permission_index_ttl())
+    user._permission_index = index
+    return index
+
+
+def has_indexed_perm(user, permission):
+    """Same answer as `user.has_perm(permission)`, without touching the database."""
+    if not user.is_active:
+        return False
+    return user.is_superuser or permission in get_permission_index(user)
+
 
 class MultiTenantPermission(BasePermission):
     '''Reusable class to check permissions'''
@@ -13,26 +80,21 @@ class MultiTenantPermission(BasePermission):
     def check_permission(self, request):
         """Check global permissions."""
         if request.user.is_authenticated:
-            print(self.permission_required)
-            print(request.user.get_user_permissions())
-            print(request.user.has_perm(self.permission_required))
-            if self.permission_required and request.user.has_perm(self.permission_required):
+            if self.permission_required and has_indexed_perm(request.user, self.permission_required):
                 return True
+            logger.debug("User %s lacks %s", request.user.pk, self.permission_required)
             raise PermissionDenied("You do not have the required permissions.")
         raise PermissionDenied("You must be authenticated to access this resource.")
 
     def get_related_field_value(self, obj):
         """
-        Get value of `related_field` (for example 'organization.tenant').
+        Get value of `related_field` (for example 'tenant_id').
         """
         if not self.related_field:
             raise PermissionDenied("related_field is not defined.")
-        fields = self.related_field.split('.')
-        value = obj
-        for field in fields:
-            value = getattr(value, field, None)
-            if value is None:
-                raise PermissionDenied(f"Field '{field}' does not exist on the object.")
+        value = getattr(obj, self.related_field, None)
+        if value is None:
+            raise PermissionDenied(f"Field '{self.related_field}' does not exist on the object.")
         return value
 
     def has_permission(self, request, view):
@@ -48,24 +110,41 @@ class MultiTenantPermission(BasePermission):
 
         related_value = self.get_related_field_value(obj)
         
-        if related_value == request.tenant:
+        if related_value == request.tenant.id:
             return True
         
-        raise PermissionDenied(f"You do not have permission to access this {self.related_field}.")
+        raise PermissionDenied(f"You do not have permission to access this {obj._meta.verbose_name}.")
 
 
 class TenantPermission(MultiTenantPermission):
     permission_required = 'tenants.can_access_tenant'
-    related_field = None
+    related_field = 'domain'
+    # Deleting a tenant purges all of its data
+    delete_permission_required = 'tenants.delete_tenant'
+
+    def has_object_permission(self, request, view, obj):
+        """
+        Tenant endpoints resolve no `request.tenant`, a tenant is in scope
+        when the request is made on its own subdomain.
+        """
+        if not self.check_permission(request):
+            return False
+
+        if self.get_related_field_value(obj) != getattr(request, 'tenant_domain', None):
+            raise PermissionDenied("You do not have permission to access this tenant.")
+
+        if request.method == 'DELETE' and not has_indexed_perm(request.user, self.delete_permission_required):
+            raise PermissionDenied("You do not have permission to delete this tenant.")
+        return True
 
 class OrganizationPermission(MultiTenantPermission):
     permission_required = 'tenants.can_access_organization'
-    related_field = 'tenant'
+    related_field = 'tenant_id'
 
 class DepartmentPermission(MultiTenantPermission):
     permission_required = 'tenants.can_access_department'
-    related_field = 'organization.tenant'
+    related_field = 'tenant_id'
 
 class CustomerPermission(MultiTenantPermission):
     permission_required = 'tenants.can_access_customer'
-    related_field = 'department.organization.tenant'
+    related_field = 'tenant_id'
@@ -0,0 +1,330 @@
+import csv
+import json
+import multiprocessing
+import os
+import tempfile
+import zlib
+from collections import Counter
+from contextlib import ExitStack
+
+import django
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .cache import TENANTS_SCOPE, bump_generation, tenant_cache, tenant_scope
+from .counters import objects_created
+from .models import Tenant, Organization, Department, Customer
+from .search import index_customers
+from .sharding import shard_aliases, sync_tenant_row
+
+# Columns of a spec row, one row per customer. A row without an email only
+# creates its tenant/organization/department.
+SPEC_FIELDS = ['tenant', 'tenant_name', 'shard', 'organization', 'department', 'first_name', 'last_name', 'email']
+FORMATS = ('csv', 'ndjson', 'json')
+# Model fields the values of the spec columns are stored in
+FIELD_OF = {
+    'tenant': (Tenant, 'domain'),
+    'tenant_name': (Tenant, 'name'),
+    'organization': (Organization, 'name'),
+    'department': (Department, 'name'),
+    'first_name': (Customer, 'first_name'),
+    'last_name': (Customer, 'last_name'),
+    'email': (Customer, 'email'),
+}
+
+
+def spec_format(path, fmt=None):
+    fmt = fmt or path.rsplit('.', 1)[-1].lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown spec format '{fmt}', use one of: {', '.join(FORMATS)}.")
+    return fmt
+
+
+def read_spec(path, fmt=None):
+    """
+    Yields (line, row) pairs of a spec file. CSV and NDJSON are read row by
+    row; a JSON document (nested tenants -> organizations -> departments ->
+    customers) is loaded whole and flattened into the same rows. NDJSON
+    lines that are not JSON objects are yielded as (line, ValueError).
+    """
+    fmt = spec_format(path, fmt)
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                yield line, row
+        elif fmt == 'ndjson':
+            for line, text in enumerate(f, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    row = json.loads(text)
+                except json.JSONDecodeError as e:
+                    yield line, ValueError(f"Invalid JSON: {e}.")
+                    continue
+                yield line, row if isinstance(row, dict) else ValueError("A row must be a JSON object.")
+        else:
+            yield from enumerate(flatten(json.load(f)), start=1)
+
+
+def flatten(document):
+    """Turns {"tenants": [{"domain", "name", "organizations": [...]}]} into spec rows."""
+    for tenant in document.get('tenants', []):
+        base = {'tenant': tenant.get('domain'), 'tenant_name': tenant.get('name'), 'shard': tenant.get('shard')}
+        yield base
+        for organization in tenant.get('organizations', []):
+            yield {**base, 'organization': organization.get('name')}
+            for department in organization.get('departments', []):
+                row = {**base, 'organization': organization.get('name'), 'department': department.get('name')}
+                yield row
+                for customer in department.get('customers', []):
+                    yield {**row, **customer}
+
+
+def clean_row(row):
+    """Returns the row with stripped values, raises ValueError when it is not usable."""
+    row = {field: str(row.get(field) or '').strip() for field in SPEC_FIELDS}
+    row['tenant'] = row['tenant'].lower()
+    if not row['tenant']:
+        raise ValueError("'tenant' is required.")
+    for field, (model, name) in FIELD_OF.items():
+        max_length = model._meta.get_field(name).max_length
+        if len(row[field]) > max_length:
+            raise ValueError(f"'{field}' is longer than {max_length} characters.")
+    if row['shard'] and row['shard'] not in shard_aliases():
+        raise ValueError(f"Unknown shard '{row['shard']}'.")
+    if row['department'] and not row['organization']:
+        raise ValueError("'department' requires 'organization'.")
+    if any(row[field] for field in ('first_name', 'last_name', 'email')):
+        if not row['department']:
+            raise ValueError("A customer requires 'department'.")
+        if not (row['first_name'] and row['last_name'] and row['email']):
+            raise ValueError("A customer requires 'first_name', 'last_name' and 'email'.")
+        try:
+            validate_email(row['email'])
+        except ValidationError:
+            raise ValueError(f"Invalid email '{row['email']}'.")
+    return row
+
+
+class Provisioner:
+    '''
+    Creates tenant hierarchies from spec rows in batches.
+
+    Each batch is written in dependency order with one lookup of the
+    existing rows and one `bulk_create` per level: tenants, organizations,
+    departments, customers. Generated ids are kept in maps keyed by natural
+    keys (domain, organization name in a tenant, department name in an
+    organization), so rows only reference their parents by name. Existing
+    tenants, organizations and departments are reused, customers are
+    always inserted. No signals are sent: the search index and the counters
+    are written with each batch, caches of the touched tenants are
+    invalidated at the end.
+    '''
+
+    def __init__(self, batch_size=5000, max_errors=100):
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.tenants = {}
+        self.tenants_by_id = {}
+        self.organizations = {}
+        self.organization_tenants = {}
+        self.departments = {}
+        self.created = Counter()
+        self.errors = []
+        self.error_count = 0
+
+    def load(self, rows, finish=True):
+        """Loads (line, row) pairs and returns a report."""
+        batch = []
+        for line, row in rows:
+            try:
+                if isinstance(row, ValueError):
+                    raise row
+                batch.append(clean_row(row))
+            except ValueError as e:
+                self.error(line, str(e))
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+        if finish:
+            self.finish()
+        return self.report()
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'error': message})
+
+    def report(self):
+        return {'created': dict(self.created), 'errors': self.errors, 'error_count': self.error_count}
+
+    def write(self, batch):
+        """Writes a batch in one transaction per database, tenants included."""
+        with ExitStack() as stack:
+            stack.enter_context(transaction.atomic(using=DEFAULT_DB_ALIAS))
+            new = self.new_tenants(batch)
+            aliases = {self.tenants[domain].shard for domain in {row['tenant'] for row in batch} - new.keys()}
+            for alias in sorted((aliases | {tenant.shard for tenant in new.values()}) - {DEFAULT_DB_ALIAS}):
+                stack.enter_context(transaction.atomic(using=alias))
+            self.write_tenants(new)
+            self.write_organizations(batch)
+            self.write_departments(batch)
+            self.write_customers(batch)
+
+    def new_tenants(self, batch):
+        """Looks up the tenants of the batch not seen yet, returns the missing ones (unsaved) by domain."""
+        missing = {row['tenant'] for row in batch} - self.tenants.keys()
+        if not missing:
+            return {}
+        for tenant in Tenant.objects.filter(domain__in=missing):
+            self.tenants[tenant.domain] = self.tenants_by_id[tenant.id] = tenant
+        new = {}
+        for row in batch:
+            if row['tenant'] in missing and row['tenant'] not in self.tenants and row['tenant'] not in new:
+                new[row['tenant']] = Tenant(
+                    domain=row['tenant'], name=row['tenant_name'] or row['tenant'], shard=row['shard'] or DEFAULT_DB_ALIAS,
+                )
+        return new
+
+    def write_tenants(self, new):
+        for tenant in Tenant.objects.bulk_create(new.values()):
+            if tenant.shard != DEFAULT_DB_ALIAS:
+                sync_tenant_row(tenant, tenant.shard)
+            self.tenants[tenant.domain] = self.tenants_by_id[tenant.id] = tenant
+        self.created['tenants'] += len(new)
+
+    def write_organizations(self, batch):
+        keys = {
+            (self.tenants[row['tenant']].id, row['organization'])
+            for row in batch if row['organization']
+        } - self.organizations.keys()
+        resolved = self._existing_or_create(
+            keys, Organization, 'tenant_id', 'organization',
+            lambda tenant_id, name: Organization(tenant_id=tenant_id, name=name),
+            lambda tenant_id: tenant_id,
+            {'deleted_at__isnull': True},
+        )
+        self.organizations.update(resolved)
+        self.organization_tenants.update(resolved.values())
+
+    def write_departments(self, batch):
+        keys = {
+            (self.organizations[(self.tenants[row['tenant']].id, row['organization'])][0], row['department'])
+            for row in batch if row['department']
+        } - self.departments.keys()
+        self.departments.update(self._existing_or_create(
+            keys, Department, 'organization_id', 'department',
+            lambda organization_id, name: Department(
+                organization_id=organization_id, tenant_id=self.organization_tenants[organization_id], name=name,
+            ),
+            lambda organization_id: self.organization_tenants[organization_id],
+        ))
+
+    def _existing_or_create(self, keys, model, parent_attname, label, build, tenant_of, filters=None):
+        """
+        Resolves (parent id, name) keys to (id, tenant id) pairs: one query for
+        the existing rows and one bulk insert for the rest, per shard.
+        """
+        resolved = {}
+        by_alias = {}
+        for key in keys:
+            alias = self.tenants_by_id[tenant_of(key[0])].shard
+            by_alias.setdefault(alias, set()).add(key)
+        for alias, alias_keys in by_alias.items():
+            existing = model.objects.using(alias).filter(
+                **{f'{parent_attname}__in': {parent for parent, _ in alias_keys}, 'name__in': {name for _, name in alias_keys}},
+                **(filters or {}),
+            ).values_list('id', parent_attname, 'name', 'tenant_id')
+            for pk, parent, name, tenant_id in existing:
+                if (parent, name) in alias_keys:
+                    resolved[(parent, name)] = (pk, tenant_id)
+            new_keys = sorted(alias_keys - resolved.keys())
+            objects = model.objects.using(alias).bulk_create([build(parent, name) for parent, name in new_keys])
+            objects_created(objects, alias)
+            for key, obj in zip(new_keys, objects):
+                resolved[key] = (obj.pk, obj.tenant_id)
+            self.created[f'{label}s'] += len(new_keys)
+        return resolved
+
+    def write_customers(self, batch):
+        by_alias = {}
+        for row in batch:
+            if not row['email']:
+                continue
+            tenant = self.tenants[row['tenant']]
+            organization_id = self.organizations[(tenant.id, row['organization'])][0]
+            department_id = self.departments[(organization_id, row['department'])][0]
+            by_alias.setdefault(tenant.shard, []).append(Customer(
+                tenant_id=tenant.id, department_id=department_id,
+                first_name=row['first_name'], last_name=row['last_name'], email=row['email'],
+            ))
+        for alias, customers in by_alias.items():
+            customers = Customer.objects.using(alias).bulk_create(customers)
+            index_customers(customers, using=alias, replace=False)
+            objects_created(customers, alias)
+            self.created['customers'] += len(customers)
+
+    def finish(self):
+        invalidate_tenants(list(self.tenants.values()), new_tenants=bool(self.created['tenants']))
+
+
+def invalidate_tenants(tenants, new_tenants=False):
+    """Invalidates cached responses and domain lookups of tenants written to without signals."""
+    for tenant in tenants:
+        bump_generation(tenant_scope(tenant.id))
+    # New domains may be cached as unknown
+    tenant_cache.invalidate(*[tenant.domain for tenant in tenants])
+    if new_tenants:
+        bump_generation(TENANTS_SCOPE)
+
+
+def load_partition(path, batch_size, max_errors):
+    """Loads a partition written by `load_parallel`, runs in a worker process."""
+    with open(path, encoding='utf-8') as f:
+        rows = (
+            (item['line'], ValueError(item['error']) if 'error' in item else item['row'])
+            for item in map(json.loads, f)
+        )
+        provisioner = Provisioner(batch_size, max_errors)
+        provisioner.load(rows, finish=False)
+    return {**provisioner.report(), 'tenants': list(provisioner.tenants)}
+
+
+def load_parallel(rows, workers, batch_size=5000, max_errors=100):
+    """
+    Loads the rows in `workers` processes. Rows are first spooled to one
+    file per worker, routed by tenant, so every tenant is written by one
+    process and processes never share a parent row. Returns the merged report.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f'partition-{index}.ndjson') for index in range(workers)]
+        with ExitStack() as stack:
+            files = [stack.enter_context(open(path, 'w', encoding='utf-8')) for path in paths]
+            for line, row in rows:
+                if isinstance(row, ValueError):
+                    files[line % workers].write(json.dumps({'line': line, 'error': str(row)}) + '\n')
+                    continue
+                index = zlib.crc32(str(row.get('tenant') or '').strip().lower().encode()) % workers
+                files[index].write(json.dumps({'line': line, 'row': row}) + '\n')
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, initializer=django.setup) as pool:
+            reports = pool.starmap(load_partition, [(path, batch_size, max_errors) for path in paths])
+
+    created = Counter()
+    errors = []
+    domains = set()
+    for report in reports:
+        created.update(report['created'])
+        errors.extend(report['errors'])
+        domains.update(report['tenants'])
+    invalidate_tenants(list(Tenant.objects.filter(domain__in=domains)), new_tenants=bool(created['tenants']))
+    errors.sort(key=lambda error: error['line'])
+    return {
+        'created': dict(created),
+        'errors': errors[:max_errors],
+        'error_count': sum(report['error_count'] for report in reports),
+    }
@@ -0,0 +1,169 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .cache import bump_generation, tenant_scope
+from .counters import object_deleted
+from .models import Tenant, Organization, Department, Customer, CustomerSearchTerm, TenantCounter, PurgeJob
+
+
+def purge_options():
+    return {'BATCH_SIZE': 1000, 'POLL_INTERVAL': 5, 'LEASE': 300, **getattr(settings, 'PURGE', {})}
+
+
+def schedule_tenant_purge(tenant):
+    """Hides the tenant (its domain stops resolving) and queues the deletion of its data."""
+    with transaction.atomic():
+        tenant.deleted_at = timezone.now()
+        # post_save invalidates the cached domain and the tenant lists
+        tenant.save(update_fields=['deleted_at'])
+        return PurgeJob.objects.create(kind=PurgeJob.TENANT, tenant_id=tenant.id, object_id=tenant.id, shard=tenant.shard)
+
+
+def schedule_organization_purge(organization):
+    """
+    Hides the organization, removes it with its departments and customers
+    from the counters and queues the deletion of its data.
+    """
+    using = router.db_for_write(Organization, instance=organization)
+    with transaction.atomic(using=using):
+        organization.deleted_at = timezone.now()
+        organization.save(update_fields=['deleted_at'])
+        # Counted from the rows rather than the organization's counter row,
+        # nothing else removes them from the tenant's counts
+        counts = Department.objects.using(using).filter(organization=organization).aggregate(
+            departments=Count('id', distinct=True), customers=Count('customers'),
+        )
+        object_deleted(organization, using, counts={'organizations': 1, **counts})
+    return PurgeJob.objects.create(
+        kind=PurgeJob.ORGANIZATION, tenant_id=organization.tenant_id, object_id=organization.id, shard=using,
+    )
+
+
+def tenant_steps(tenant_id):
+    """(table, queryset) pairs of all data of a tenant, leaves first."""
+    rows = {'tenant_id': tenant_id}
+    return [
+        ('search_terms', CustomerSearchTerm.objects.filter(**rows)),
+        ('customers', Customer.objects.filter(**rows)),
+        ('departments', Department.objects.filter(**rows)),
+        ('organizations', Organization.objects.filter(**rows)),
+        ('counters', TenantCounter.objects.filter(**rows)),
+    ]
+
+
+def purge_steps(job):
+    """(table, queryset) pairs deleted in this order, leaves first, so no step needs cascades."""
+    if job.kind == PurgeJob.TENANT:
+        return tenant_steps(job.tenant_id)
+    departments = Department.objects.filter(organization_id=job.object_id).values('id')
+    return [
+        ('search_terms', CustomerSearchTerm.objects.filter(customer__department__organization_id=job.object_id)),
+        ('customers', Customer.objects.filter(department__organization_id=job.object_id)),
+        # Rows of departments recreated by writes made after the organization was hidden
+        ('counters', TenantCounter.objects.filter(
+            Q(level=TenantCounter.DEPARTMENT, object_id__in=departments)
+            | Q(level=TenantCounter.ORGANIZATION, object_id=job.object_id),
+            tenant_id=job.tenant_id,
+        )),
+        ('departments', Department.objects.filter(organization_id=job.object_id)),
+        ('organizations', Organization.objects.filter(pk=job.object_id)),
+    ]
+
+
+def delete_batch(queryset, using, batch_size):
+    """Deletes up to `batch_size` rows with one id lookup and one DELETE, returns their number."""
+    ids = list(queryset.using(using).order_by().values_list('id', flat=True)[:batch_size])
+    if ids:
+        # A raw DELETE: no collector loading the rows, no signals and no
+        # cascades, the children are gone already
+        queryset.model.objects.using(using).filter(id__in=ids)._raw_delete(using)
+    return len(ids)
+
+
+def run_job(job, batch_size=None, log=None):
+    """
+    Deletes the rows of a job in batches of `batch_size`, each in its own
+    transaction, and records the progress on the job. Every step is
+    repeated until it finds no rows, and the steps until a whole pass
+    deletes nothing, so a job can be resumed after a crash and rows added
+    meanwhile are deleted as well.
+    """
+    log = log or (lambda message: None)
+    batch_size = batch_size or purge_options()['BATCH_SIZE']
+    steps = purge_steps(job)
+    while True:
+        deleted = blocked = 0
+        for table, queryset in steps:
+            while True:
+                try:
+                    with transaction.atomic(using=job.shard):
+                        count = delete_batch(queryset, job.shard, batch_size)
+                except IntegrityError:
+                    # Rows were added below this level since its step ran,
+                    # the next pass deletes them first
+                    blocked += 1
+                    break
+                if not count:
+                    break
+                deleted += count
+                job.deleted[table] = job.deleted.get(table, 0) + count
+                job.save(update_fields=['deleted', 'updated_at'])
+                log(f"Deleted {count} {table} of {job}.")
+        if not deleted:
+            if blocked:
+                raise IntegrityError(f"{job} is blocked by rows referencing the deleted ones.")
+            break
+
+    if job.kind == PurgeJob.TENANT:
+        # Cascades only to the shard copy of the tenant and the emptied tables
+        Tenant.objects.filter(pk=job.tenant_id).delete()
+    bump_generation(tenant_scope(job.tenant_id))
+    job.status = PurgeJob.DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at', 'updated_at'])
+
+
+def claim_job(lease=None):
+    """
+    Marks the oldest pending job, or a running one whose worker stopped
+    updating it for `lease` seconds, as running and returns it.
+    """
+    lease = purge_options()['LEASE'] if lease is None else lease
+    with transaction.atomic():
+        job = PurgeJob.objects.select_for_update(skip_locked=True).filter(
+            Q(status=PurgeJob.PENDING)
+            | Q(status=PurgeJob.RUNNING, updated_at__lt=timezone.now() - timedelta(seconds=lease))
+        ).order_by('id').first()
+        if job is not None:
+            job.status = PurgeJob.RUNNING
+            job.attempts += 1
+            job.save(update_fields=['status', 'attempts', 'updated_at'])
+    return job
+
+
+def run_worker(batch_size=None, poll_interval=None, once=False, log=None):
+    """Runs jobs until interrupted; with `once` until no job is left. Returns the number of finished jobs."""
+    log = log or (lambda message: None)
+    poll_interval = purge_options()['POLL_INTERVAL'] if poll_interval is None else poll_interval
+    finished = 0
+    while True:
+        job = claim_job()
+        if job is None:
+            if once:
+                return finished
+            time.sleep(poll_interval)
+            continue
+        log(f"Running {job}.")
+        try:
+            run_job(job, batch_size, log)
+        except Exception as e:
+            PurgeJob.objects.filter(pk=job.pk).update(status=PurgeJob.FAILED, error=str(e), updated_at=timezone.now())
+            log(f"{job} failed: {e}")
+        else:
+            finished += 1
+            log(f"Finished {job}.")
@@ -0,0 +1,58 @@
+from decimal import Decimal
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _has_float(data):
+    """
+    True if the data contains floats (or Decimals, encoded as floats),
+    which orjson formats differently from `json` (1e16 vs 1e+16, NaN as null).
+    """
+    stack = [data]
+    while stack:
+        obj = stack.pop()
+        kind = type(obj)
+        if kind is dict:
+            if any(type(key) is float for key in obj):
+                return True
+            stack.extend(obj.values())
+        elif kind is list or kind is tuple:
+            stack.extend(obj)
+        elif kind is float or isinstance(obj, (float, Decimal)):
+            return True
+    return False
+
+
+class ORJSONRenderer(JSONRenderer):
+    '''
+    JSONRenderer producing the same bytes with orjson when it is installed.
+
+    Dates and times are passed to DRF's encoder, so datetimes end with 'Z'
+    like DRF's. Data with floats, data orjson cannot encode (e.g. integers
+    over 64 bits) and indented output are rendered by the standard renderer,
+    as is everything without orjson. Like DRF, U+2028/U+2029 are escaped so
+    the output is also valid JavaScript.
+    '''
+    options = (
+        orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if orjson is not None else 0
+    )
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None or data is None
+            or self.get_indent(accepted_media_type, renderer_context or {})
+            or _has_float(data)
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=encoders.JSONEncoder().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
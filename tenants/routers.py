@@ -0,0 +1,193 @@
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger('tenants.routers')
+
+_current_shard = contextvars.ContextVar('current_shard', default=None)
+
+# Models whose rows live on the shard of their tenant. Tenant itself is
+# kept on the default database, shards hold a copy for the foreign keys.
+SHARDED_MODELS = {'organization', 'department', 'customer', 'customersearchterm', 'tenantcounter'}
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+def activate_shard(alias):
+    """Routes the sharded models of the current request to `alias`, returns a token for `deactivate_shard`."""
+    return _current_shard.set(alias)
+
+
+def deactivate_shard(token):
+    _current_shard.reset(token)
+
+
+@contextmanager
+def use_shard(alias):
+    """Routes the sharded models to `alias` inside the block, e.g. in management commands."""
+    token = activate_shard(alias)
+    try:
+        yield alias
+    finally:
+        deactivate_shard(token)
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'tenants' and model._meta.model_name in SHARDED_MODELS
+
+
+class TenantShardRouter:
+    '''
+    Routes organizations, departments and customers to the database of
+    their tenant (`Tenant.shard`).
+
+    The shard comes from the instance involved in the query when there is
+    one (an object loaded from a shard, or a tenant/parent assigned to a new
+    object), otherwise from the shard activated for the current request by
+    TenantMiddleware or with `use_shard`. Everything else uses the default
+    database. The tenants app is migrated on every database.
+    '''
+
+    def _shard_for(self, model, instance=None):
+        if not is_sharded(model):
+            return None
+        if instance is not None and instance._meta.app_label == 'tenants':
+            if instance._meta.model_name == 'tenant':
+                return instance.shard
+            if is_sharded(type(instance)):
+                if instance._state.db:
+                    return instance._state.db
+                for field in ('tenant', getattr(instance, 'parent_field', None)):
+                    if field and instance._meta.get_field(field).is_cached(instance):
+                        related = getattr(instance, field)
+                        return related.shard if field == 'tenant' else related._state.db
+        return current_shard()
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'tenants' and model._meta.model_name == 'tenant':
+            return DEFAULT_DB_ALIAS
+        return self._shard_for(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # A tenant (default database) may be related to rows on its shard
+        if 'tenant' in (obj1._meta.model_name, obj2._meta.model_name) and obj1._meta.app_label == obj2._meta.app_label == 'tenants':
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'tenants':
+            return True
+        return db == DEFAULT_DB_ALIAS
+
+
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+
+def activate_replica_reads(enabled=True):
+    """Lets reads of the current request go to replicas, returns a token for `deactivate_replica_reads`."""
+    return _replica_reads.set(enabled)
+
+
+def deactivate_replica_reads(token):
+    _replica_reads.reset(token)
+
+
+def measure_lag(alias):
+    """Replication lag of a database in seconds, 0 for databases that are not replaying WAL."""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+        )
+        return float(cursor.fetchone()[0] or 0)
+
+
+class ReplicaRouter(TenantShardRouter):
+    '''
+    Sends reads to a replica of the database chosen by TenantShardRouter
+    when ReplicaMiddleware allowed it for the request (safe method, no
+    recent write by the tenant or user). Writes always go to the primary,
+    objects read from a replica are saved to its primary.
+
+    Replicas lagging more than REPLICA_ROUTING['MAX_LAG'] seconds are
+    skipped; the lag of each replica is measured at most every
+    LAG_CHECK_INTERVAL seconds per process.
+    '''
+
+    def __init__(self):
+        self.replicas = getattr(settings, 'DATABASE_REPLICAS', {})
+        self.primaries = {replica: primary for primary, replicas in self.replicas.items() for replica in replicas}
+        options = getattr(settings, 'REPLICA_ROUTING', {})
+        self.max_lag = options.get('MAX_LAG')
+        self.lag_check_interval = options.get('LAG_CHECK_INTERVAL', 5)
+        self.fallback_to_primary = options.get('FALLBACK_TO_PRIMARY', True)
+        self._lag = {}
+        self._lock = threading.Lock()
+
+    def primary_of(self, alias):
+        return self.primaries.get(alias, alias)
+
+    def _primary(self, db, hints):
+        if db is None:
+            instance = hints.get('instance')
+            db = instance._state.db if instance is not None and instance._state.db else DEFAULT_DB_ALIAS
+        return self.primary_of(db)
+
+    def db_for_read(self, model, **hints):
+        primary = self._primary(super().db_for_read(model, **hints), hints)
+        if not _replica_reads.get() or not self.replicas.get(primary):
+            return primary
+        return self.choose_replica(primary)
+
+    def db_for_write(self, model, **hints):
+        return self._primary(super().db_for_write(model, **hints), hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self.primary_of(obj1._state.db) == self.primary_of(obj2._state.db):
+            return True
+        return super().allow_relation(obj1, obj2, **hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.primaries:
+            return False
+        return super().allow_migrate(db, app_label, model_name, **hints)
+
+    def choose_replica(self, primary):
+        replicas = self.replicas[primary]
+        usable = [replica for replica in replicas if self.is_usable(replica)]
+        if usable:
+            return random.choice(usable)
+        if self.fallback_to_primary:
+            return primary
+        return min(replicas, key=lambda replica: self._lag.get(replica, (math.inf, 0))[0])
+
+    def is_usable(self, alias):
+        if self.max_lag is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            lag, checked_at = self._lag.get(alias, (None, None))
+        if checked_at is None or now - checked_at >= self.lag_check_interval:
+            try:
+                lag = measure_lag(alias)
+            except DatabaseError:
+                logger.warning("Replica %s is not reachable", alias, exc_info=True)
+                lag = math.inf
+            with self._lock:
+                self._lag[alias] = (lag, now)
+        return lag <= self.max_lag
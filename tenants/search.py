@@ -0,0 +1,98 @@
+import re
+import unicodedata
+from functools import reduce
+from operator import or_
+
+from django.db import router
+from django.db.models import Case, F, IntegerField, Max, Q, When
+
+from .models import Customer, CustomerSearchTerm
+
+SEARCH_FIELDS = ('first_name', 'last_name', 'email')
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 5
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercases and strips accents, so 'Żaneta' and 'zaneta' give the same term."""
+    text = unicodedata.normalize('NFKD', text.replace('ł', 'l').replace('Ł', 'L'))
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def tokenize(text):
+    return [word[:MAX_TERM_LENGTH] for word in _WORD.findall(normalize(text or ''))]
+
+
+def customer_terms(first_name, last_name, email):
+    """Terms of a customer: words of the names and of the email, and the whole email."""
+    terms = set(tokenize(first_name)) | set(tokenize(last_name)) | set(tokenize(email))
+    if email:
+        terms.add(normalize(email)[:MAX_TERM_LENGTH])
+    return terms
+
+
+def index_customers(customers, using=None, replace=True):
+    """
+    Writes the terms of the customers with one bulk insert. With `replace`
+    the existing terms of the customers are deleted first (updates).
+    """
+    customers = [customer for customer in customers if customer.pk is not None]
+    if not customers:
+        return
+    using = using or router.db_for_write(CustomerSearchTerm, instance=customers[0])
+    if replace:
+        CustomerSearchTerm.objects.using(using).filter(customer__in=[customer.pk for customer in customers]).delete()
+    CustomerSearchTerm.objects.using(using).bulk_create(
+        CustomerSearchTerm(tenant_id=customer.tenant_id, customer_id=customer.pk, term=term)
+        for customer in customers
+        for term in customer_terms(*(getattr(customer, field) for field in SEARCH_FIELDS))
+    )
+
+
+def search_customers(tenant, query):
+    """
+    Returns a queryset of {'customer_id', 'rank'} dicts of the tenant's
+    customers matching every word of the query as a prefix of one of their
+    terms, best first. An exact term match ranks higher than a prefix match.
+    Customers of organizations waiting for their purge are left out.
+    """
+    words = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not words:
+        return CustomerSearchTerm.objects.none()
+    matches = {
+        f'match_{index}': Max(Case(
+            When(term=word, then=2),
+            When(term__startswith=word, then=1),
+            default=0,
+            output_field=IntegerField(),
+        ))
+        for index, word in enumerate(words)
+    }
+    return (
+        CustomerSearchTerm.objects
+        .filter(tenant=tenant, customer__department__organization__deleted_at__isnull=True)
+        .filter(reduce(or_, [Q(term__startswith=word) for word in words]))
+        .values('customer_id')
+        .annotate(**matches)
+        .filter(**{f'{name}__gt': 0 for name in matches})
+        .annotate(rank=reduce(lambda total, name: total + F(name), list(matches)[1:], F(next(iter(matches)))))
+        .order_by('-rank', 'customer_id')
+        .values('customer_id', 'rank')
+    )
+
+
+def rebuild_index(tenant, using=None, batch_size=2000):
+    """Recreates the terms of all customers of a tenant, returns the number of indexed customers."""
+    using = using or router.db_for_write(CustomerSearchTerm, instance=tenant)
+    CustomerSearchTerm.objects.using(using).filter(tenant=tenant).delete()
+    count = 0
+    batch = []
+    for customer in Customer.objects.using(using).filter(tenant=tenant).only('id', 'tenant_id', *SEARCH_FIELDS).iterator(chunk_size=batch_size):
+        batch.append(customer)
+        if len(batch) >= batch_size:
+            index_customers(batch, using, replace=False)
+            count += len(batch)
+            batch = []
+    index_customers(batch, using, replace=False)
+    return count + len(batch)
@@ -0,0 +1,71 @@
+from itertools import islice
+
+from django.contrib.auth.models import Permission, User
+from django.db import router
+from rest_framework.authtoken.models import Token
+
+from .counters import objects_created
+from .models import Tenant, Organization, Department, Customer
+from .search import index_customers
+
+ACCESS_PERMISSIONS = ['can_access_tenant', 'can_access_organization', 'can_access_department', 'can_access_customer']
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def bulk_insert(model, objects, using, batch_size=1000):
+    """Inserts the objects in batches and returns them with their ids."""
+    created = []
+    for batch in batched(objects, batch_size):
+        created.extend(model.objects.using(using).bulk_create(batch))
+    return created
+
+
+def seed(tenants, organizations, departments, customers, prefix='bench', batch_size=1000):
+    """
+    Creates `tenants` tenants with `organizations` organizations each,
+    `departments` departments per organization and `customers` customers per
+    department, with bulk inserts. Tenant domains are `<prefix>-<n>`.
+    Returns the created tenants.
+    """
+    created_tenants = Tenant.objects.bulk_create(
+        Tenant(domain=f'{prefix}-{t}', name=f'{prefix.title()} {t}') for t in range(tenants)
+    )
+    for tenant in created_tenants:
+        using = router.db_for_write(Organization, instance=tenant)
+        orgs = bulk_insert(Organization, (
+            Organization(tenant=tenant, name=f'Organization {o}') for o in range(organizations)
+        ), using, batch_size)
+        depts = bulk_insert(Department, (
+            Department(tenant=tenant, organization=organization, name=f'Department {d}')
+            for organization in orgs for d in range(departments)
+        ), using, batch_size)
+        custs = bulk_insert(Customer, (
+            Customer(
+                tenant=tenant, department=department, first_name=f'First {c}', last_name=f'Last {c}',
+                email=f'customer{department.id}.{c}@{tenant.domain}.example.com',
+            )
+            for department in depts for c in range(customers)
+        ), using, batch_size)
+        for batch in batched(custs, batch_size):
+            index_customers(batch, using, replace=False)
+        for objects in (orgs, depts, custs):
+            objects_created(objects, using)
+    return created_tenants
+
+
+def delete_seeded(prefix='bench'):
+    """Deletes the tenants created by `seed` (and their data) and the benchmark users."""
+    Tenant.objects.filter(domain__startswith=f'{prefix}-').delete()
+    User.objects.filter(username__startswith=f'{prefix}-').delete()
+
+
+def create_api_user(username):
+    """Creates a user with access to all endpoints and returns its API token."""
+    user = User.objects.create_user(username)
+    user.user_permissions.set(Permission.objects.filter(content_type__app_label='tenants', codename__in=ACCESS_PERMISSIONS))
+    return Token.objects.get_or_create(user=user)[0].key
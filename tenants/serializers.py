@@ -2,19 +2,38 @@ from rest_framework import serializers
 from .models import Tenant, Organization, Department, Customer
 
 
+def values_fields(serializer_class):
+    """
+    (output key, values() lookup) pairs producing the same dicts as the
+    serializer, for serializers whose fields are plain columns or foreign keys
+    rendered as primary keys.
+    """
+    model = serializer_class.Meta.model
+    return [(name, model._meta.get_field(name).attname) for name in serializer_class.Meta.fields]
+
+
 class TenantSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tenant
-        fields = ['id', 'name', 'domain']
-        read_only_fields = ['id']
+        fields = ['id', 'name', 'domain', 'version']
+        read_only_fields = ['id', 'version']
+
+    def to_internal_value(self, data):
+        # Nowy tenant dostaje domenę z subdomeny requestu (ustawioną przez TenantMiddleware)
+        domain = getattr(self.context.get('request'), 'tenant_domain', None)
+        if self.instance is None and domain:
+            data = data.copy()
+            data['domain'] = domain
+        return super().to_internal_value(data)
 
 
 class OrganizationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Organization
-        fields = ['id', 'name', 'tenant']
-        read_only_fields = ['id']
+        fields = ['id', 'name', 'tenant', 'version']
+        # Tenant pochodzi zawsze z request.tenant, nie z body
+        read_only_fields = ['id', 'tenant', 'version']
     
     def create(self, validated_data):
         # Pobierz tenant z requestu i przypisz go do organizacji
@@ -26,7 +45,7 @@ class OrganizationSerializer(serializers.ModelSerializer):
 
 class DepartmentSerializer(serializers.ModelSerializer):
     organization = serializers.PrimaryKeyRelatedField(
-        queryset=Organization.objects.all(),
+        queryset=Organization.objects.filter(deleted_at__isnull=True),
         error_messages={
             'does_not_exist': 'Organization with this ID does not exist.',
             'invalid': 'Invalid tenant ID.',
@@ -35,13 +54,13 @@ class DepartmentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Department
-        fields = ['id', 'name', 'organization']
-        read_only_fields = ['id']
+        fields = ['id', 'name', 'organization', 'version']
+        read_only_fields = ['id', 'version']
 
 
 class CustomerSerializer(serializers.ModelSerializer):
     department = serializers.PrimaryKeyRelatedField(
-        queryset=Department.objects.all(),
+        queryset=Department.objects.filter(organization__deleted_at__isnull=True),
         error_messages={
             'does_not_exist': 'Departament with this ID does not exist.',
             'invalid': 'Invalid tenant ID.',
@@ -50,5 +69,22 @@ class CustomerSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Customer
-        fields = ['id', 'first_name', 'last_name', 'email', 'department']
-        read_only_fields = ['id']
\ No newline at end of file
+        fields = ['id', 'first_name', 'last_name', 'email', 'department', 'version']
+        read_only_fields = ['id', 'version']
+
+class DepartmentBulkSerializer(serializers.ModelSerializer):
+    '''Validates one row of a bulk request, ownership of the organization is checked for the whole batch.'''
+    organization = serializers.IntegerField()
+
+    class Meta:
+        model = Department
+        fields = ['name', 'organization']
+
+
+class CustomerBulkSerializer(serializers.ModelSerializer):
+    '''Validates one row of a bulk request, ownership of the department is checked for the whole batch.'''
+    department = serializers.IntegerField()
+
+    class Meta:
+        model = Customer
+        fields = ['first_name', 'last_name', 'email', 'department']
@@ -0,0 +1,175 @@
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import Max
+
+from .cache import bump_generation, tenant_cache, tenant_scope
+from .counters import reconcile
+from .models import Tenant, Organization, Department, Customer
+from .purge import delete_batch, tenant_steps
+from .search import rebuild_index
+
+# Copied in dependency order
+SHARDED_TABLES = [Organization, Department, Customer]
+
+
+def sync_tenant_row(tenant, alias):
+    """Creates or updates the copy of the tenant row kept on a shard for its foreign keys."""
+    values = {'domain': tenant.domain, 'name': tenant.name, 'shard': tenant.shard}
+    if not Tenant.objects.using(alias).filter(pk=tenant.pk).update(**values):
+        Tenant.objects.using(alias).bulk_create([Tenant(pk=tenant.pk, **values)])
+
+
+def shard_aliases():
+    """Aliases of the databases tenants can live on: the default one and the shards, in DATABASES order."""
+    replicas = {replica for aliases in getattr(settings, 'DATABASE_REPLICAS', {}).values() for replica in aliases}
+    return [alias for alias in settings.DATABASES if alias not in replicas]
+
+
+def id_ranges():
+    """
+    Database alias -> (first, last) id its sharded rows get: the default
+    database and the shards, in DATABASES order, each take the next
+    SHARD_ID_RANGE ids (without it all share one range). Replicas are left out.
+    """
+    size = getattr(settings, 'SHARD_ID_RANGE', None)
+    aliases = shard_aliases()
+    if not size:
+        return {alias: (1, None) for alias in aliases}
+    return {alias: (index * size + 1, (index + 1) * size) for index, alias in enumerate(aliases)}
+
+
+def _sequence_value(connection, table):
+    """Last id handed out by the counter of the table, its name, or (None, None) if there is none."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f"SELECT last_value, is_called FROM {sequence}")
+            value, called = cursor.fetchone()
+            return (value if called else value - 1), sequence
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            row = cursor.fetchone()
+            return (row[0] if row else 0), table
+    return None, None
+
+
+def reset_sequences(alias, models=SHARDED_TABLES):
+    """
+    Points the id counters of the sharded tables on `alias` past its highest
+    id within its range (see `id_ranges`). New rows then get ids from the
+    range, never ids copied in from other databases. PostgreSQL and SQLite
+    only, other databases keep their counters; SQLite also never goes below
+    the highest id in the table, so there ranges only hold until a tenant
+    is moved in from a database with a higher range.
+    """
+    first, last = id_ranges()[alias]
+    connection = connections[alias]
+    for model in models:
+        table = model._meta.db_table
+        current, sequence = _sequence_value(connection, table)
+        if sequence is None:
+            continue
+        ids = model.objects.using(alias).filter(id__gte=first)
+        if last is not None:
+            ids = ids.filter(id__lte=last)
+        value = ids.aggregate(highest=Max('id'))['highest'] or first - 1
+        if first <= current <= (current if last is None else last):
+            # Ids handed out and deleted since are not reused
+            value = max(value, current)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT setval(%s::regclass, %s, %s)", [sequence, max(value, first), value >= first])
+            else:
+                cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [value, table])
+                if not cursor.rowcount:
+                    cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, value])
+
+
+def copy_rows(model, tenant, source, target, batch_size):
+    """
+    Copies the tenant's rows of `model` from `source` to `target` in batches,
+    with their ids. Returns the number of rows.
+    """
+    attnames = [field.attname for field in model._meta.concrete_fields]
+    rows = model.objects.using(source).filter(tenant=tenant).order_by('id').values_list(*attnames)
+    count = 0
+    batch = []
+    for values in rows.iterator(chunk_size=batch_size):
+        batch.append(model(**dict(zip(attnames, values))))
+        if len(batch) >= batch_size:
+            model.objects.using(target).bulk_create(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        model.objects.using(target).bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def move_tenant(tenant, target, batch_size=1000, grace=None, log=None):
+    """
+    Moves the organizations, departments and customers of a tenant to the
+    `target` database with their ids, returns the number of copied rows per
+    model.
+
+    Rows are copied in one transaction on the target, which fails without
+    changes when an id is already used there (databases hand out ids from
+    separate ranges, see `id_ranges`). Then the tenant is switched
+    and, after `grace` seconds (workers may still have the tenant with the
+    old shard in their local cache), its rows are deleted from the source
+    in batches. Writes to the tenant during the move are not carried over,
+    so it should not be written to until the command finishes.
+    """
+    log = log or (lambda message: None)
+    source = tenant.shard
+    if target not in shard_aliases():
+        raise ValueError(f"Unknown database '{target}'.")
+    if target == source:
+        raise ValueError(f"Tenant '{tenant.domain}' is already on '{target}'.")
+
+    if target != DEFAULT_DB_ALIAS:
+        sync_tenant_row(tenant, target)
+    copied = {}
+    try:
+        with transaction.atomic(using=target):
+            for model in SHARDED_TABLES:
+                copied[model] = copy_rows(model, tenant, source, target, batch_size)
+                log(f"Copied {copied[model]} {model._meta.verbose_name_plural}.")
+            # SQLite moves its counters up to the highest inserted id
+            reset_sequences(target)
+            # Search terms and counters are derived data, they are rebuilt instead of copied
+            rebuild_index(tenant, using=target)
+            reconcile(tenant, using=target)
+    except IntegrityError as e:
+        raise ValueError(f"Ids of tenant '{tenant.domain}' are already used on '{target}', nothing was moved: {e}")
+
+    tenant.shard = target
+    Tenant.objects.filter(pk=tenant.pk).update(shard=target)
+    if target != DEFAULT_DB_ALIAS:
+        sync_tenant_row(tenant, target)
+    tenant_cache.invalidate(tenant.domain)
+    bump_generation(tenant_scope(tenant.pk))
+    log(f"Tenant '{tenant.domain}' now uses '{target}'.")
+
+    grace = getattr(settings, 'TENANT_CACHE', {}).get('TTL', 300) if grace is None else grace
+    if grace:
+        log(f"Waiting {grace}s for cached tenants of other workers to expire.")
+        time.sleep(grace)
+    # Raw batched deletes, leaves first, like the purge worker: no rows are
+    # loaded and no signals fan out (the tenant's counters go with its rows)
+    steps = tenant_steps(tenant.pk)
+    if source != DEFAULT_DB_ALIAS:
+        steps.append(('tenants', Tenant.objects.filter(pk=tenant.pk)))
+    for table, queryset in steps:
+        deleted = 0
+        while True:
+            with transaction.atomic(using=source):
+                count = delete_batch(queryset, source, batch_size)
+            if not count:
+                break
+            deleted += count
+        log(f"Deleted {deleted} {table} from '{source}'.")
+    return copied
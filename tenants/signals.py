@@ -1,10 +1,106 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save, m2m_changed
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group, Permission
+from tenants.cache import tenant_cache, bump_generation, tenant_scope, TENANTS_SCOPE
+from tenants.counters import object_deleted, object_moved, objects_created
+from tenants.models import Tenant, Organization, Department, Customer
+from tenants.search import index_customers
+from tenants.sharding import sync_tenant_row
 
 @receiver(post_save, sender=User)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
-        Token.objects.create(user=instance)
\ No newline at end of file
+        Token.objects.create(user=instance)
+
+@receiver(pre_save, sender=Tenant)
+def remember_tenant_domain(sender, instance, **kwargs):
+    # The domain may be changing, so the old cache entry has to go as well
+    instance._previous_domain = None
+    if instance.pk and not kwargs.get('raw'):
+        instance._previous_domain = Tenant.objects.filter(pk=instance.pk).values_list('domain', flat=True).first()
+
+@receiver(post_save, sender=Tenant)
+@receiver(post_delete, sender=Tenant)
+def invalidate_tenant_cache(sender, instance, **kwargs):
+    tenant_cache.invalidate(instance.domain, getattr(instance, '_previous_domain', None))
+
+@receiver(post_save, sender=Tenant)
+def copy_tenant_to_shard(sender, instance, using, raw=False, **kwargs):
+    # Shards keep a copy of the tenant row for the foreign keys of its data
+    if using == DEFAULT_DB_ALIAS and instance.shard != DEFAULT_DB_ALIAS and not raw:
+        sync_tenant_row(instance, instance.shard)
+
+@receiver(post_delete, sender=Tenant)
+def delete_tenant_from_shard(sender, instance, using, **kwargs):
+    # Deleting on the default database does not cascade to the shard
+    if using == DEFAULT_DB_ALIAS and instance.shard != DEFAULT_DB_ALIAS:
+        Tenant.objects.using(instance.shard).filter(pk=instance.pk).delete()
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_auth_snapshots(sender, **kwargs):
+    bump_generation('auth')
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_permission_index(sender, action=None, **kwargs):
+    # m2m_changed is sent before and after the change, only the latter matters
+    if action is None or action.startswith('post_'):
+        bump_generation('permissions')
+
+
+@receiver(post_save, sender=Tenant)
+@receiver(post_delete, sender=Tenant)
+def invalidate_tenant_responses(sender, instance, **kwargs):
+    bump_generation(TENANTS_SCOPE)
+    bump_generation(tenant_scope(instance.pk))
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def invalidate_tenant_data(sender, instance, **kwargs):
+    bump_generation(tenant_scope(instance.tenant_id))
+    # A move between tenants changes what both of them see
+    previous = getattr(instance, '_loaded_tenant_id', None)
+    if previous is not None and previous != instance.tenant_id:
+        bump_generation(tenant_scope(previous))
+
+@receiver(post_save, sender=Customer)
+def index_customer(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        index_customers([instance], using=using)
+
+@receiver(post_save, sender=Organization)
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=Customer)
+def count_object(sender, instance, using, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        objects_created([instance], using)
+    else:
+        object_moved(instance, using)
+
+@receiver(pre_delete, sender=Organization)
+@receiver(pre_delete, sender=Department)
+@receiver(pre_delete, sender=Customer)
+def uncount_object(sender, instance, using, origin=None, **kwargs):
+    # Only the objects the delete started from: their counts include the
+    # cascaded descendants, and a deleted tenant takes its counters along
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin is None or origin_model is sender:
+        object_deleted(instance, using)
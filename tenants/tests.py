@@ -0,0 +1,679 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.db.models import F
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import purge
+from .cache import get_generation, tenant_cache, tenant_scope
+from .counters import COUNTER_FIELDS, expected_counters, reconcile
+from .instrumentation import QueryBudgetExceeded
+from .models import Tenant, Organization, Department, Customer, CustomerSearchTerm, TenantCounter, PurgeJob
+from .provisioning import Provisioner
+from .routers import use_shard
+from .sharding import shard_aliases
+
+
+class TenantAPIMixin:
+    '''A tenant with one organization, department and a few customers, and a client of a user allowed everything.'''
+    customers = 5
+
+    @classmethod
+    def create_data(cls):
+        cls.tenant = Tenant.objects.create(domain='acme', name='Acme')
+        cls.organization = Organization.objects.create(tenant=cls.tenant, name='Sales')
+        cls.department = Department.objects.create(organization=cls.organization, name='North')
+        for index in range(cls.customers):
+            Customer.objects.create(
+                department=cls.department, first_name=f'Jan{index}', last_name='Kowalski', email=f'jan{index}@acme.pl',
+            )
+        cls.user = User.objects.create_user('alice')
+        cls.user.user_permissions.add(*Permission.objects.filter(codename__startswith='can_access'))
+
+    def setUp(self):
+        # Tokens, tenants and permission indexes are cached across requests
+        cache.clear()
+        tenant_cache.clear()
+        self.client = self.client_for(self.tenant)
+
+    def warm_up(self, path='/api/organizations/'):
+        """Caches the token, the permission index and the tenant like the requests after the first one of a user."""
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+    def client_for(self, tenant, **extra):
+        return Client(HTTP_HOST=f'{tenant.domain}.localhost', HTTP_AUTHORIZATION=f'token {self.user.auth_token.key}', **extra)
+
+
+class TenantAPITestCase(TenantAPIMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_data()
+
+
+def query_budget(**options):
+    """QUERY_BUDGET with the middleware enabled and failing over budget requests."""
+    return {**settings.QUERY_BUDGET, 'ENABLED': True, 'RAISE': True, **options}
+
+
+@override_settings(RESPONSE_CACHE={'ENABLED': False})
+class QueryBudgetTests(TenantAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.warm_up()
+
+    def test_lists_are_within_their_budgets(self):
+        with override_settings(QUERY_BUDGET=query_budget()):
+            client = self.client_for(self.tenant)
+            for path in (
+                '/api/organizations/',
+                f'/api/departments/?organization={self.organization.id}',
+                f'/api/customers/?department={self.department.id}',
+            ):
+                self.assertEqual(client.get(path).status_code, 200, path)
+
+    def test_over_budget_request_raises(self):
+        with override_settings(QUERY_BUDGET=query_budget(VIEWS={('organization-list', 'GET'): 0})):
+            client = self.client_for(self.tenant)
+            with self.assertRaises(QueryBudgetExceeded):
+                client.get('/api/organizations/')
+
+    def test_creates_are_not_held_to_the_list_budget(self):
+        with override_settings(QUERY_BUDGET=query_budget(VIEWS={('organization-list', 'GET'): 0})):
+            client = self.client_for(self.tenant)
+            response = client.post('/api/organizations/', {'name': 'Support'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+
+class QueryPlanTests(TenantAPITestCase):
+
+    def test_queries_use_indexes(self):
+        stdout = StringIO()
+        # Raises CommandError if any of the queries scans a whole table
+        call_command('check_query_plans', domain='acme', token=self.user.auth_token.key, verbose_plans=True, stdout=stdout)
+        output = stdout.getvalue()
+        for name in ('organization-list', 'organization-export', 'customer-list', 'customer-export', 'customer-search'):
+            self.assertIn(f'{name}: index scan', output)
+        self.assertNotIn('sequential scan', output)
+
+
+@override_settings(RESPONSE_CACHE={'ENABLED': False})
+class ListQueryTests(TenantAPITestCase):
+    '''Warm lists run one query, however many rows they return.'''
+
+    def setUp(self):
+        super().setUp()
+        self.warm_up()
+
+    def assertListQueries(self, path, num):
+        with self.assertNumQueries(num):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_organization_list(self):
+        self.assertListQueries('/api/organizations/', 1)
+        Organization.objects.bulk_create([Organization(tenant=self.tenant, name=f'Org{i}') for i in range(20)])
+        self.assertListQueries('/api/organizations/', 1)
+
+    def test_department_list(self):
+        path = f'/api/departments/?organization={self.organization.id}'
+        self.assertListQueries(path, 1)
+        Department.objects.bulk_create([
+            Department(organization=self.organization, tenant=self.tenant, name=f'Dep{i}') for i in range(20)
+        ])
+        self.assertListQueries(path, 1)
+
+    def test_customer_list(self):
+        path = f'/api/customers/?department={self.department.id}'
+        self.assertListQueries(path, 1)
+        Customer.objects.bulk_create([
+            Customer(department=self.department, tenant=self.tenant, first_name=f'Anna{i}', last_name='Nowak')
+            for i in range(20)
+        ])
+        response = self.assertListQueries(path, 1)
+        self.assertEqual(len(response.json()['results']), self.customers + 20)
+
+
+try:
+    from django.db.backends.postgresql.base import DatabaseWrapper as PostgresDatabaseWrapper
+except ImportError:
+    PostgresDatabaseWrapper = None
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    @skipUnless(PostgresDatabaseWrapper, "psycopg is not installed.")
+    def test_pool_options_are_accepted(self):
+        # Django passes the health check itself, the options must not repeat it
+        database = PostgresDatabaseWrapper({
+            **connection.settings_dict, 'ENGINE': 'django.db.backends.postgresql', 'NAME': 'mtm_db',
+            'CONN_MAX_AGE': 0, 'OPTIONS': {'pool': settings.DB_POOL_OPTIONS},
+        }, alias='pool_options')
+        self.addCleanup(database.close_pool)
+        self.assertEqual(database.pool.max_size, settings.DB_POOL_MAX_SIZE)
+
+
+class PooledConnectionTests(TestCase):
+
+    @skipUnless('pool' in connection.settings_dict['OPTIONS'], "The database is not pooled.")
+    def test_pooled_connection(self):
+        with connection.pool.connection() as pooled:
+            self.assertEqual(pooled.execute('SELECT 1').fetchone(), (1,))
+
+
+class ProvisioningTests(TestCase):
+
+    def provision(self, lines, suffix='.ndjson'):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False, encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.addCleanup(os.remove, f.name)
+        stdout = StringIO()
+        call_command('provision_tenants', f.name, stdout=stdout)
+        return json.loads(stdout.getvalue())
+
+    def test_creates_the_hierarchy(self):
+        report = self.provision([json.dumps({
+            'tenant': 'acme', 'organization': 'Sales', 'department': 'North',
+            'first_name': 'Jan', 'last_name': 'Kowalski', 'email': 'jan@acme.pl',
+        })])
+        self.assertEqual(report['created'], {'tenants': 1, 'organizations': 1, 'departments': 1, 'customers': 1})
+        self.assertEqual(report['errors'], [])
+        self.assertTrue(Customer.objects.filter(tenant__domain='acme', department__name='North').exists())
+
+    def test_invalid_rows_are_reported(self):
+        report = self.provision([
+            json.dumps({'tenant': 'acme', 'organization': 'Sales'}),
+            '{"tenant": "broken"',
+            json.dumps({'tenant': 'elsewhere', 'shard': 'nope'}),
+            json.dumps({'tenant': 'acme', 'organization': 'x' * 256}),
+            '["acme"]',
+        ])
+        self.assertEqual([error['line'] for error in report['errors']], [2, 3, 4, 5])
+        self.assertIn("Invalid JSON", report['errors'][0]['error'])
+        self.assertEqual(report['errors'][1]['error'], "Unknown shard 'nope'.")
+        self.assertEqual(report['errors'][2]['error'], "'organization' is longer than 255 characters.")
+        self.assertEqual(report['error_count'], 4)
+        self.assertEqual(list(Tenant.objects.values_list('domain', flat=True)), ['acme'])
+        self.assertEqual(Organization.objects.count(), 1)
+
+    def test_failed_batch_leaves_no_tenant(self):
+        with mock.patch.object(Provisioner, 'write_customers', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            self.provision([json.dumps({'tenant': 'acme', 'organization': 'Sales'})])
+        self.assertFalse(Tenant.objects.exists())
+
+
+@override_settings(RESPONSE_CACHE={'ENABLED': False})
+class VersionTests(TenantAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = f'/api/organizations/{self.organization.id}/'
+
+    def test_etag_is_the_version(self):
+        response = self.client.get(self.path)
+        self.assertEqual(response['ETag'], '"1"')
+        self.assertEqual(response.json()['version'], 1)
+
+    def test_if_none_match(self):
+        for header in ('"1"', 'W/"1"', '"0", W/"1"', '*'):
+            response = self.client.get(self.path, HTTP_IF_NONE_MATCH=header)
+            self.assertEqual(response.status_code, 304, header)
+            self.assertEqual(response['ETag'], '"1"')
+        self.assertEqual(self.client.get(self.path, HTTP_IF_NONE_MATCH='"2"').status_code, 200)
+
+    def patch(self, data, **headers):
+        return self.client.patch(self.path, data, content_type='application/json', **headers)
+
+    def test_update_with_current_version(self):
+        response = self.patch({'name': 'Marketing'}, HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"2"')
+        self.assertEqual(response.json()['version'], 2)
+        self.assertEqual(self.client.get(self.path)['ETag'], '"2"')
+        self.organization.refresh_from_db()
+        self.assertEqual((self.organization.name, self.organization.version), ('Marketing', 2))
+
+    def test_update_with_stale_version(self):
+        self.patch({'name': 'Marketing'}, HTTP_IF_MATCH='"1"')
+        response = self.patch({'name': 'Support'}, HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], '"2"')
+        self.organization.refresh_from_db()
+        self.assertEqual((self.organization.name, self.organization.version), ('Marketing', 2))
+
+    def test_update_losing_a_race(self):
+        save_if_version = Organization.save_if_version
+
+        def concurrent_write(instance, expected, update_fields):
+            # Another request updates the row between the fetch and the UPDATE
+            Organization.objects.filter(pk=instance.pk).update(name='Support', version=F('version') + 1)
+            return save_if_version(instance, expected, update_fields)
+
+        with mock.patch.object(Organization, 'save_if_version', concurrent_write):
+            response = self.patch({'name': 'Marketing'}, HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], '"2"')
+        self.organization.refresh_from_db()
+        self.assertEqual((self.organization.name, self.organization.version), ('Support', 2))
+
+    def test_update_without_if_match(self):
+        self.patch({'name': 'Support'}, HTTP_IF_MATCH='"1"')
+        response = self.patch({'name': 'Marketing'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"3"')
+        self.organization.refresh_from_db()
+        self.assertEqual((self.organization.name, self.organization.version), ('Marketing', 3))
+
+
+class BulkUpsertTests(TenantAPITestCase):
+
+    def upsert(self, path, rows):
+        response = self.client.post(f'{path}?upsert=true', rows, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def customer(self, email, first_name='Anna'):
+        return {'department': self.department.id, 'first_name': first_name, 'last_name': 'Nowak', 'email': email}
+
+    def test_created_updated_and_unchanged(self):
+        report = self.upsert('/api/customers/bulk/', [self.customer('jan0@acme.pl'), self.customer('anna@acme.pl')])
+        self.assertEqual(report, {'created': 1, 'updated': 1, 'unchanged': 0, 'errors': []})
+        updated = Customer.objects.get(department=self.department, email='jan0@acme.pl')
+        self.assertEqual((updated.first_name, updated.version), ('Anna', 2))
+        self.assertEqual(Customer.objects.filter(department=self.department).count(), 6)
+
+        report = self.upsert('/api/departments/bulk/', [
+            {'organization': self.organization.id, 'name': 'North'}, {'organization': self.organization.id, 'name': 'East'},
+        ])
+        self.assertEqual(report, {'created': 1, 'updated': 0, 'unchanged': 1, 'errors': []})
+
+    @override_settings(BULK_BATCH_SIZE=2)
+    def test_duplicate_keys(self):
+        # The duplicates of a key land in different chunks
+        rows = [
+            self.customer('anna@acme.pl'), self.customer('jan0@acme.pl', 'Ewa'), self.customer('ewa@acme.pl'),
+            self.customer('anna@acme.pl', 'Zofia'), self.customer('jan0@acme.pl', 'Maria'), {'email': 'invalid'},
+        ]
+        report = self.upsert('/api/customers/bulk/', rows)
+        self.assertEqual((report['created'], report['updated'], report['unchanged']), (2, 1, 0))
+        self.assertEqual([error['index'] for error in report['errors']], [0, 1, 5])
+        self.assertEqual(report['errors'][0]['errors'], {'email': ['Duplicate key in the request, superseded by row 3.']})
+        self.assertEqual(report['errors'][1]['errors'], {'email': ['Duplicate key in the request, superseded by row 4.']})
+        self.assertEqual(
+            report['created'] + report['updated'] + report['unchanged'] + len(report['errors']), len(rows),
+        )
+        self.assertEqual(Customer.objects.get(department=self.department, email='anna@acme.pl').first_name, 'Zofia')
+        self.assertEqual(Customer.objects.get(department=self.department, email='jan0@acme.pl').first_name, 'Maria')
+        self.assertEqual(Customer.objects.filter(department=self.department).count(), 7)
+
+
+@override_settings(RESPONSE_CACHE={'ENABLED': False})
+class SearchTests(TenantAPITestCase):
+
+    def search(self, query, client=None):
+        response = (client or self.client).get('/api/customers/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [(row['email'], row['rank']) for row in response.json()['results']]
+
+    def test_prefix_matches(self):
+        Customer.objects.create(department=self.department, first_name='Jan', last_name='Nowak', email='jn@acme.pl')
+        Customer.objects.create(department=self.department, first_name='Żaneta', last_name='Łódź', email='zl@acme.pl')
+        # The exact term ranks above the prefixes of Jan0..Jan4
+        self.assertEqual(self.search('jan'), [('jn@acme.pl', 2)] + [(f'jan{index}@acme.pl', 1) for index in range(5)])
+        # Every word has to match
+        self.assertEqual(self.search('jan2 kowal'), [('jan2@acme.pl', 3)])
+        # The words of an email: jan0, acme and pl
+        self.assertEqual(self.search('jan0@acme.pl'), [('jan0@acme.pl', 6)])
+        self.assertEqual(self.search('ZANETA lodz'), [('zl@acme.pl', 4)])
+        self.assertEqual(self.search('nowakowski'), [])
+        self.assertEqual(self.client.get('/api/customers/search/', {'q': '@'}).status_code, 400)
+
+    def test_updates_replace_the_terms(self):
+        customer = Customer.objects.get(email='jan0@acme.pl')
+        response = self.client.patch(
+            f'/api/customers/{customer.id}/', {'last_name': 'Nowak'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('jan0@acme.pl', [email for email, _ in self.search('kowalski')])
+        self.assertEqual(self.search('nowak'), [('jan0@acme.pl', 2)])
+
+    def test_deletes_remove_the_terms(self):
+        customer = Customer.objects.get(email='jan0@acme.pl')
+        self.assertEqual(self.client.delete(f'/api/customers/{customer.id}/').status_code, 204)
+        self.assertEqual(self.search('jan0'), [])
+        self.assertFalse(CustomerSearchTerm.objects.filter(customer_id=customer.id).exists())
+
+    def test_results_of_the_current_tenant_only(self):
+        other = Tenant.objects.create(domain='beta', name='Beta')
+        department = Department.objects.create(organization=Organization.objects.create(tenant=other, name='Sales'), name='North')
+        Customer.objects.create(department=department, first_name='Jan', last_name='Kowalski', email='jan@beta.pl')
+
+        self.assertEqual(len(self.search('kowalski')), 5)
+        self.assertNotIn('jan@beta.pl', [email for email, _ in self.search('jan')])
+        self.assertEqual(self.search('kowalski', self.client_for(other)), [('jan@beta.pl', 2)])
+
+
+SHARDS = shard_aliases()
+
+
+@skipUnless(len(SHARDS) > 1, "Needs a shard, e.g. with --settings=MultiTenantManager.test_settings.")
+class ShardTests(TenantAPITestCase):
+    databases = set(SHARDS)
+
+    def create_tenant(self, domain, shard):
+        tenant = Tenant.objects.create(domain=domain, name=domain, shard=shard)
+        # Like management commands, code outside requests names the shard
+        with use_shard(shard):
+            organization = Organization.objects.create(tenant=tenant, name='Sales')
+            department = Department.objects.create(organization=organization, name='North')
+            Customer.objects.create(department=department, first_name='Jan', last_name='Kowalski', email='jan@beta.pl')
+        return tenant
+
+    def test_rows_are_routed_to_the_tenant_shard(self):
+        shard = SHARDS[1]
+        tenant = self.create_tenant('beta', shard)
+        for model in (Organization, Department, Customer):
+            self.assertTrue(model.objects.using(shard).filter(tenant=tenant).exists(), model)
+            self.assertFalse(model.objects.using('default').filter(tenant=tenant).exists(), model)
+
+        client = self.client_for(tenant)
+        response = client.post('/api/organizations/', {'name': 'Support'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Organization.objects.using(shard).filter(pk=response.json()['id'], tenant=tenant).exists())
+        names = [row['name'] for row in client.get('/api/organizations/').json()['results']]
+        self.assertEqual(names, ['Sales', 'Support'])
+
+    def test_move_tenant(self):
+        shard = SHARDS[1]
+        ids = {model: set(model.objects.filter(tenant=self.tenant).values_list('id', flat=True))
+               for model in (Organization, Department, Customer)}
+        self.assertEqual(tenant_cache.get('acme').shard, 'default')
+
+        call_command('move_tenant', 'acme', shard, grace=0, stdout=StringIO())
+
+        for model, model_ids in ids.items():
+            self.assertEqual(set(model.objects.using(shard).filter(tenant=self.tenant).values_list('id', flat=True)), model_ids)
+            self.assertFalse(model.objects.using('default').filter(tenant=self.tenant).exists(), model)
+        self.assertFalse(TenantCounter.objects.using('default').filter(tenant=self.tenant).exists())
+        self.assertEqual(TenantCounter.objects.using(shard).get(tenant=self.tenant, level=TenantCounter.TENANT).customers, self.customers)
+        self.assertEqual(tenant_cache.get('acme').shard, shard)
+        response = self.client.get(f'/api/customers/?department={self.department.id}')
+        self.assertEqual({row['id'] for row in response.json()['results']}, ids[Customer])
+
+
+REPLICAS = [alias for alias, database in settings.DATABASES.items() if database.get('TEST', {}).get('MIRROR') == 'default']
+
+
+@skipUnless(REPLICAS, "Needs a replica of the default database, e.g. with --settings=MultiTenantManager.test_settings.")
+@override_settings(
+    DATABASE_REPLICAS={'default': REPLICAS[:1]},
+    # ReplicaRouter reads the replicas when it is created
+    DATABASE_ROUTERS=['tenants.routers.ReplicaRouter'],
+    MIDDLEWARE=[name for name in settings.MIDDLEWARE if name != 'tenants.middleware.ReplicaMiddleware']
+    + ['tenants.middleware.ReplicaMiddleware'],
+    REPLICA_ROUTING={**settings.REPLICA_ROUTING, 'PIN_SECONDS': 60},
+    RESPONSE_CACHE={'ENABLED': False},
+)
+class ReplicaTests(TenantAPIMixin, TransactionTestCase):
+    # Committed data: the replica has its own connection to the database
+    databases = {'default', *REPLICAS[:1]}
+
+    def setUp(self):
+        self.create_data()
+        super().setUp()
+        self.replica = REPLICAS[0]
+        self.warm_up()
+
+    def queries(self, method, path, **kwargs):
+        """Response and the number of queries run on the primary and on the replica."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections[self.replica]) as replica:
+            response = getattr(self.client, method)(path, **kwargs)
+        return response, len(primary), len(replica)
+
+    def test_reads_go_to_the_replica(self):
+        response, primary, replica = self.queries('get', '/api/organizations/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((primary, replica), (0, 1))
+
+    def test_writes_go_to_the_primary_and_pin_reads(self):
+        response, primary, replica = self.queries(
+            'post', '/api/organizations/', data={'name': 'Support'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+        self.assertTrue(cache.get(f'replica:pin:tenant:{self.tenant.id}'))
+        self.assertTrue(cache.get(f'replica:pin:user:{self.user.id}'))
+
+        response, primary, replica = self.queries('get', '/api/organizations/')
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual((primary, replica), (1, 0))
+
+    def test_user_pin_covers_other_tenants(self):
+        other = Tenant.objects.create(domain='beta', name='Beta')
+        cache.set(f'replica:pin:user:{self.user.id}', True)
+        self.client = self.client_for(other)
+        response, primary, replica = self.queries('get', '/api/organizations/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+
+    def test_failed_writes_do_not_pin(self):
+        response = self.client.post('/api/organizations/', {}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(cache.get(f'replica:pin:tenant:{self.tenant.id}'))
+
+
+class Interrupted(BaseException):
+    '''Stands for the worker process being killed, run_worker only catches Exception.'''
+
+
+@override_settings(PURGE={'BATCH_SIZE': 2, 'POLL_INTERVAL': 0, 'LEASE': 0})
+class PurgeTests(TenantAPITestCase):
+    databases = set(SHARDS)
+
+    def run_interrupted(self, batches):
+        """Runs the worker until it deleted `batches` batches, then kills it."""
+        delete_batch = purge.delete_batch
+
+        def interrupting(*args, **kwargs):
+            if not batches_left.pop():
+                raise Interrupted
+            return delete_batch(*args, **kwargs)
+
+        batches_left = [False] + [True] * batches
+        with mock.patch.object(purge, 'delete_batch', interrupting), self.assertRaises(Interrupted):
+            purge.run_worker(once=True)
+
+    def assertCountersMatch(self, tenant, using):
+        # Nothing for reconcile to fix
+        self.assertEqual(reconcile(tenant, using), {'created': 0, 'updated': 0, 'deleted': 0})
+
+    def test_organization_purge(self):
+        other = Organization.objects.create(tenant=self.tenant, name='Support')
+        generation = get_generation(tenant_scope(self.tenant.id))
+        response = self.client.delete(f'/api/organizations/{self.organization.id}/')
+        self.assertEqual(response.status_code, 202)
+        # Hidden and uncounted right away
+        self.assertEqual([row['id'] for row in self.client.get('/api/organizations/').json()['results']], [other.id])
+        counter = TenantCounter.objects.get(tenant=self.tenant, level=TenantCounter.TENANT)
+        self.assertEqual((counter.organizations, counter.departments, counter.customers), (1, 0, 0))
+
+        self.run_interrupted(batches=3)
+        job = PurgeJob.objects.get()
+        self.assertEqual(job.status, PurgeJob.RUNNING)
+        self.assertTrue(Customer.objects.filter(department=self.department).exists())
+
+        self.assertEqual(purge.run_worker(once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PurgeJob.DONE)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.deleted['customers'], self.customers)
+        self.assertFalse(Organization.objects.filter(pk=self.organization.pk).exists())
+        self.assertFalse(Department.objects.filter(pk=self.department.pk).exists())
+        self.assertFalse(Customer.objects.filter(tenant=self.tenant).exists())
+        self.assertFalse(CustomerSearchTerm.objects.filter(tenant=self.tenant).exists())
+        self.assertTrue(Organization.objects.filter(pk=other.pk).exists())
+        self.assertCountersMatch(self.tenant, 'default')
+        self.assertGreater(get_generation(tenant_scope(self.tenant.id)), generation)
+
+    def test_tenant_purge_on_its_shard(self):
+        shard = SHARDS[-1]
+        tenant = Tenant.objects.create(domain='beta', name='Beta', shard=shard)
+        with use_shard(shard):
+            organization = Organization.objects.create(tenant=tenant, name='Sales')
+            department = Department.objects.create(organization=organization, name='North')
+            for index in range(5):
+                Customer.objects.create(department=department, first_name='Jan', last_name='Kowalski', email=f'{index}@beta.pl')
+        purge.schedule_tenant_purge(tenant)
+        self.assertEqual(self.client_for(tenant).get('/api/organizations/').status_code, 400)
+
+        self.run_interrupted(batches=2)
+        self.assertEqual(purge.run_worker(once=True), 1)
+        self.assertEqual(PurgeJob.objects.get().status, PurgeJob.DONE)
+        for model in (Organization, Department, Customer, CustomerSearchTerm, TenantCounter):
+            self.assertFalse(model.objects.using(shard).filter(tenant_id=tenant.id).exists(), model)
+        self.assertFalse(Tenant.objects.filter(pk=tenant.pk).exists())
+        self.assertFalse(Tenant.objects.using(shard).filter(pk=tenant.pk).exists())
+        # The other tenant is untouched
+        self.assertEqual(Customer.objects.filter(tenant=self.tenant).count(), self.customers)
+        self.assertCountersMatch(self.tenant, 'default')
+
+
+class CounterTests(TenantAPITestCase):
+
+    def assertCountersMatch(self, tenant=None):
+        tenant = tenant or self.tenant
+        rows = {
+            (row['level'], row['object_id']): {field: row[field] for field in COUNTER_FIELDS}
+            for row in TenantCounter.objects.filter(tenant=tenant).values('level', 'object_id', *COUNTER_FIELDS)
+        }
+        self.assertEqual(rows, expected_counters(tenant.id, 'default'))
+        self.assertEqual(rows[(TenantCounter.TENANT, tenant.id)], {
+            'organizations': Organization.objects.filter(tenant=tenant).count(),
+            'departments': Department.objects.filter(tenant=tenant).count(),
+            'customers': Customer.objects.filter(tenant=tenant).count(),
+        })
+
+    def post(self, path, data):
+        response = self.client.post(path, data, content_type='application/json')
+        self.assertLess(response.status_code, 300, response.content)
+        return response.json()
+
+    def test_creates_and_deletes(self):
+        self.assertCountersMatch()
+        organization = self.post('/api/organizations/', {'name': 'Support'})
+        department = self.post('/api/departments/', {'name': 'South', 'organization': organization['id']})
+        customer = self.post('/api/customers/', {
+            'department': department['id'], 'first_name': 'Anna', 'last_name': 'Nowak', 'email': 'anna@acme.pl',
+        })
+        self.assertCountersMatch()
+
+        self.assertEqual(self.client.delete(f"/api/customers/{customer['id']}/").status_code, 204)
+        self.assertCountersMatch()
+        # Cascades to the customers of the department
+        self.assertEqual(self.client.delete(f'/api/departments/{self.department.id}/').status_code, 204)
+        self.assertCountersMatch()
+
+    def test_moves(self):
+        organization = Organization.objects.create(tenant=self.tenant, name='Support')
+        department = Department.objects.create(organization=organization, name='South')
+        # The API keeps customers in their department, the admin moves them
+        customer = Customer.objects.filter(department=self.department).first()
+        customer.department = department
+        customer.save()
+        self.assertCountersMatch()
+
+        self.department.organization = organization
+        self.department.save()
+        self.assertCountersMatch()
+
+        other = Tenant.objects.create(domain='beta', name='Beta')
+        organization.tenant = other
+        organization.save()
+        self.assertCountersMatch()
+        self.assertCountersMatch(other)
+
+    def test_bulk_writes(self):
+        customers = [
+            {'department': self.department.id, 'first_name': 'Anna', 'last_name': 'Nowak', 'email': f'anna{index}@acme.pl'}
+            for index in range(3)
+        ]
+        self.post('/api/customers/bulk/', customers)
+        self.assertCountersMatch()
+        # Updates and creates, the updated rows keep their department
+        self.post('/api/customers/bulk/?upsert=true', customers[1:] + [{**customers[0], 'email': 'ewa@acme.pl'}])
+        self.assertCountersMatch()
+        self.post('/api/departments/bulk/?upsert=true', [
+            {'organization': self.organization.id, 'name': 'North'}, {'organization': self.organization.id, 'name': 'East'},
+        ])
+        self.assertCountersMatch()
+
+    def test_reconcile_command(self):
+        TenantCounter.objects.filter(tenant=self.tenant, level=TenantCounter.TENANT).update(customers=99)
+        TenantCounter.objects.filter(tenant=self.tenant, level=TenantCounter.DEPARTMENT).delete()
+        TenantCounter.objects.create(tenant=self.tenant, level=TenantCounter.DEPARTMENT, object_id=12345)
+
+        stdout = StringIO()
+        call_command('reconcile_counters', domain='acme', stdout=stdout)
+        self.assertIn("'acme': created 1, updated 1, deleted 1 counter rows.", stdout.getvalue())
+        self.assertCountersMatch()
+
+        stdout = StringIO()
+        call_command('reconcile_counters', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), "'acme': counters are up to date.")
+
+
+@override_settings(PERMISSION_INDEX_TTL=3600, AUTH_SNAPSHOT_TTL=3600, RESPONSE_CACHE={'ENABLED': False})
+class RevocationTests(TenantAPITestCase):
+    '''Revoked access is refused by the very next request, not after the cached indexes expire.'''
+
+    def setUp(self):
+        super().setUp()
+        self.warm_up()
+
+    def assertStatus(self, status_code):
+        self.assertEqual(self.client.get('/api/organizations/').status_code, status_code)
+
+    def test_removed_permission(self):
+        self.user.user_permissions.remove(Permission.objects.get(codename='can_access_organization'))
+        self.assertStatus(403)
+
+    def test_removed_group_membership(self):
+        group = Group.objects.create(name='staff')
+        group.permissions.add(Permission.objects.get(codename='can_access_organization'))
+        self.user.groups.add(group)
+        self.user.user_permissions.remove(Permission.objects.get(codename='can_access_organization'))
+        self.assertStatus(200)
+        self.user.groups.remove(group)
+        self.assertStatus(403)
+
+    def test_permission_removed_from_group(self):
+        permission = Permission.objects.get(codename='can_access_organization')
+        group = Group.objects.create(name='staff')
+        group.permissions.add(permission)
+        self.user.groups.add(group)
+        self.user.user_permissions.remove(permission)
+        self.assertStatus(200)
+        group.permissions.remove(permission)
+        self.assertStatus(403)
+
+    def test_deleted_token(self):
+        self.user.auth_token.delete()
+        self.assertStatus(401)
+
+    def test_deactivated_user(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertStatus(401)
@@ -0,0 +1,41 @@
+from django.db.models import Count
+
+from .models import Organization, Department
+
+# Levels below the tenant, by depth
+TREE_DEPTHS = {0: 'tenant', 1: 'organizations', 2: 'departments'}
+# Optional fields of the nodes; ids and children are always included
+TREE_FIELDS = ('name', 'customer_count')
+
+
+def tenant_tree(tenant, depth=2, fields=TREE_FIELDS):
+    """
+    Returns the tenant with its organizations and their departments nested,
+    down to `depth`, with one query per level. With 'customer_count' in
+    `fields` departments carry the number of their customers, counted by
+    the department query.
+    """
+    node = {'id': tenant.id, 'domain': tenant.domain}
+    if 'name' in fields:
+        node['name'] = tenant.name
+    if depth < 1:
+        return node
+
+    columns = ['id', 'name'] if 'name' in fields else ['id']
+    organizations = {
+        row['id']: {**row, 'departments': []} if depth >= 2 else row
+        for row in Organization.objects.filter(tenant=tenant, deleted_at__isnull=True).order_by('id').values(*columns)
+    }
+    node['organizations'] = list(organizations.values())
+    if depth < 2:
+        return node
+
+    departments = Department.objects.filter(tenant=tenant).order_by('organization_id', 'id')
+    if 'customer_count' in fields:
+        departments = departments.annotate(customer_count=Count('customers'))
+        columns = [*columns, 'customer_count']
+    for row in departments.values('organization_id', *columns):
+        organization = organizations.get(row.pop('organization_id'))
+        if organization is not None:
+            organization['departments'].append(row)
+    return node
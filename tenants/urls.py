@@ -4,7 +4,7 @@ from rest_framework.permissions import IsAuthenticated
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework.authtoken.views import obtain_auth_token
-from .views import TenantViewSet, OrganizationViewSet, DepartmentViewSet, CustomerViewSet
+from .views import TenantViewSet, OrganizationViewSet, DepartmentViewSet, CustomerViewSet, StatsViewSet
 
 # Tworzysz router
 router = DefaultRouter()
@@ -12,6 +12,7 @@ router.register(r'tenants', TenantViewSet)
 router.register(r'organizations', OrganizationViewSet)
 router.register(r'departments', DepartmentViewSet)
 router.register(r'customers', CustomerViewSet)
+router.register(r'stats', StatsViewSet, basename='stats')
 
 
 urlpatterns = [
@@ -1,25 +1,101 @@
+from django.db.models import Exists, OuterRef
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from rest_framework import viewsets
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.exceptions import ValidationError, PermissionDenied
 from rest_framework.response import Response
 from rest_framework import status
-from .models import Tenant, Organization, Department, Customer
-from .serializers import TenantSerializer, OrganizationSerializer, DepartmentSerializer, CustomerSerializer
-from .permissions import TenantPermission, OrganizationPermission, DepartmentPermission, CustomerPermission
+from .models import Tenant, Organization, Department, Customer, TenantCounter, PurgeJob
+from .serializers import TenantSerializer, OrganizationSerializer, DepartmentSerializer, CustomerSerializer, values_fields
+from .authentication import CachedTokenAuthentication
+from .bulk import DepartmentBulkWriter, CustomerBulkWriter
+from .cache import TENANTS_SCOPE
+from .export import CUSTOMER_EXPORT_FIELDS, export_response
+from .mixins import TenantCachedResponseMixin, ValuesListMixin, VersionedUpdateMixin
+from .pagination import SearchPagination, TenantCursorPagination
+from .parsers import NDJSONParser
+from .purge import schedule_organization_purge, schedule_tenant_purge
+from .permissions import TenantPermission, OrganizationPermission, DepartmentPermission, CustomerPermission, has_indexed_perm
+from .search import search_customers, tokenize
+from .tree import TREE_DEPTHS, TREE_FIELDS, tenant_tree
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
-class TenantViewSet(viewsets.ModelViewSet):
+OUTPUT_PARAMETER = openapi.Parameter(
+    'output', openapi.IN_QUERY, description="Export format: 'ndjson' (default) or 'json'", type=openapi.TYPE_STRING
+)
+
+
+def get_id_param(request, name):
+    """Returns an optional integer query parameter."""
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValidationError({"detail": f"Parameter '{name}' must be an integer."})
+    return int(value)
+
+
+UPSERT_PARAMETER = openapi.Parameter(
+    'upsert', openapi.IN_QUERY, description="Update rows matching an existing natural key instead of creating them", type=openapi.TYPE_BOOLEAN
+)
+
+
+def bulk_write(request, writer_class):
+    """Runs a bulk writer over the request body and builds the response."""
+    upsert = request.query_params.get('upsert', '').lower() in ('1', 'true')
+    report = writer_class(request.tenant, upsert=upsert).write(request.data)
+    valid = report['created'] + report['updated'] + report['unchanged']
+    if report['errors'] and not valid:
+        return Response(report, status=status.HTTP_400_BAD_REQUEST)
+    return Response(report, status=status.HTTP_200_OK)
+
+
+def purge_job_response(request, job, url_name, response_status=status.HTTP_200_OK):
+    """State of a purge job, with the URL it can be polled at."""
+    return Response({
+        'id': job.id,
+        'kind': job.kind,
+        'object_id': job.object_id,
+        'status': job.status,
+        'deleted': job.deleted,
+        'error': job.error,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+        'url': request.build_absolute_uri(reverse(url_name, kwargs={'job_id': job.id})),
+    }, status=response_status)
+
+class TenantViewSet(VersionedUpdateMixin, TenantCachedResponseMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing tenants.
     """
-    queryset = Tenant.objects.all()
+    queryset = Tenant.objects.filter(deleted_at__isnull=True)
     serializer_class = TenantSerializer
     permission_classes = [TenantPermission]
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
-class OrganizationViewSet(viewsets.ModelViewSet):
+    def get_response_cache_scope(self):
+        # Tenants are not scoped to the tenant of the request
+        return TENANTS_SCOPE
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        Hide the tenant and delete its data in the background (see `run_purge_worker`).
+        """
+        job = schedule_tenant_purge(self.get_object())
+        return purge_job_response(request, job, 'tenant-purge-job', status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], url_path=r'purge-jobs/(?P<job_id>[0-9]+)', url_name='purge-job')
+    def purge_job(self, request, job_id=None):
+        """
+        State of the deletion of a tenant.
+        """
+        job = get_object_or_404(PurgeJob, pk=job_id, kind=PurgeJob.TENANT)
+        return purge_job_response(request, job, 'tenant-purge-job')
+
+class OrganizationViewSet(VersionedUpdateMixin, TenantCachedResponseMixin, ValuesListMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing organizations.
     Organizations are filtered based on the current tenant.
@@ -27,13 +103,14 @@ class OrganizationViewSet(viewsets.ModelViewSet):
     queryset = Organization.objects.all()
     serializer_class = OrganizationSerializer
     permission_classes = [OrganizationPermission]
+    pagination_class = TenantCursorPagination
 
     def get_queryset(self):
         """
         Retrieve organizations associated with the active tenant.
         """
         tenant = self.request.tenant
-        return Organization.objects.filter(tenant=tenant)
+        return Organization.objects.filter(tenant=tenant, deleted_at__isnull=True)
 
     def perform_create(self, serializer):
         """
@@ -46,25 +123,77 @@ class OrganizationViewSet(viewsets.ModelViewSet):
         """
         Ensure the organization belongs to the current tenant.
         """
-        if instance.tenant != self.request.tenant:
+        if instance.tenant_id != self.request.tenant.id:
             raise PermissionDenied("You do not have permission to modify this organization.")
 
-    def update(self, request, *args, **kwargs):
-        instance = self.get_object()
-        self.validate_organization(instance)
-        return super().update(request, *args, **kwargs)
-
-    def partial_update(self, request, *args, **kwargs):
-        instance = self.get_object()
+    def validate_update(self, instance):
         self.validate_organization(instance)
-        return super().partial_update(request, *args, **kwargs)
 
     def destroy(self, request, *args, **kwargs):
+        """
+        Hide the organization and delete its departments and customers in the background.
+        """
         instance = self.get_object()
         self.validate_organization(instance)
-        return super().destroy(request, *args, **kwargs)
+        job = schedule_organization_purge(instance)
+        return purge_job_response(request, job, 'organization-purge-job', status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], url_path=r'purge-jobs/(?P<job_id>[0-9]+)', url_name='purge-job')
+    def purge_job(self, request, job_id=None):
+        """
+        State of the deletion of an organization of the current tenant.
+        """
+        job = get_object_or_404(PurgeJob, pk=job_id, kind=PurgeJob.ORGANIZATION, tenant_id=request.tenant.id)
+        return purge_job_response(request, job, 'organization-purge-job')
 
-class DepartmentViewSet(viewsets.ModelViewSet):
+    @swagger_auto_schema(manual_parameters=[OUTPUT_PARAMETER])
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Stream all customers of the organization.
+        """
+        organization = self.get_object()
+        if not has_indexed_perm(request.user, 'tenants.can_access_customer'):
+            raise PermissionDenied("You do not have the required permissions.")
+        queryset = Customer.objects.filter(tenant=request.tenant, department__organization=organization)
+        return export_response(request, queryset, CUSTOMER_EXPORT_FIELDS, f'organization-{organization.id}-customers')
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('depth', openapi.IN_QUERY, description="0: tenant, 1: organizations, 2: departments (default)", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('fields', openapi.IN_QUERY, description=f"Comma separated optional fields: {', '.join(TREE_FIELDS)} (default all)", type=openapi.TYPE_STRING),
+        ]
+    )
+    @action(detail=False, methods=['get'])
+    def tree(self, request):
+        """
+        The current tenant with its organizations and departments in one response.
+        """
+        depth = get_id_param(request, 'depth')
+        depth = max(TREE_DEPTHS) if depth is None else depth
+        if depth not in TREE_DEPTHS:
+            raise ValidationError({"detail": f"Parameter 'depth' must be at most {max(TREE_DEPTHS)}."})
+        fields = request.query_params.get('fields')
+        fields = TREE_FIELDS if fields is None else [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = set(fields) - set(TREE_FIELDS)
+        if unknown:
+            raise ValidationError({"detail": f"Unknown fields: {', '.join(sorted(unknown))}."})
+
+        # Cached trees are shared by the tenant's users, so the permissions
+        # for the requested levels are checked before the cache
+        required = []
+        if depth >= 2:
+            required.append('tenants.can_access_department')
+            if 'customer_count' in fields:
+                required.append('tenants.can_access_customer')
+        if not all(has_indexed_perm(request.user, permission) for permission in required):
+            raise PermissionDenied("You do not have the required permissions.")
+        return self.cached_response(request, self.tree_response, depth, fields)
+
+    def tree_response(self, request, depth, fields):
+        return Response(tenant_tree(request.tenant, depth, fields))
+
+class DepartmentViewSet(VersionedUpdateMixin, TenantCachedResponseMixin, ValuesListMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing departments.
     Departments are filtered by the organization and tenant.
@@ -72,7 +201,8 @@ class DepartmentViewSet(viewsets.ModelViewSet):
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
     permission_classes = [DepartmentPermission]
-    authentication_classes = [TokenAuthentication]
+    pagination_class = TenantCursorPagination
+    authentication_classes = [CachedTokenAuthentication]
 
     @swagger_auto_schema(
         manual_parameters=[
@@ -92,22 +222,31 @@ class DepartmentViewSet(viewsets.ModelViewSet):
         if 'pk' in self.kwargs:
             return Department.objects.filter(
                 pk=self.kwargs['pk'],
-                organization__tenant=self.request.tenant
+                tenant=self.request.tenant,
+                organization__deleted_at__isnull=True
             )
 
-        organization_id = self.request.query_params.get('organization')
-        if not organization_id:
+        # Ownership of the organization is implied by the tenant filter, it is
+        # checked separately only when the page is empty (see list_response)
+        return Department.objects.filter(
+            organization=self.get_organization_id(),
+            tenant=self.request.tenant,
+            organization__deleted_at__isnull=True
+        )
+
+    def get_organization_id(self):
+        organization_id = get_id_param(self.request, 'organization')
+        if organization_id is None:
             raise ValidationError({"detail": "Parameter 'organization' is required in query params."})
+        return organization_id
 
-        if not Organization.objects.filter(
-            id=organization_id, tenant=self.request.tenant
+    def list_response(self, request, *args, **kwargs):
+        response = super().list_response(request, *args, **kwargs)
+        if not response.data['results'] and not Organization.objects.filter(
+            id=self.get_organization_id(), tenant=request.tenant, deleted_at__isnull=True
         ).exists():
             raise ValidationError({"detail": "Invalid organization for the current tenant."})
-
-        return Department.objects.filter(
-            organization=organization_id,
-            organization__tenant=self.request.tenant
-        ).select_related('organization', 'organization__tenant')
+        return response
 
     def perform_create(self, serializer):
         """
@@ -120,7 +259,8 @@ class DepartmentViewSet(viewsets.ModelViewSet):
         try:
             organization = Organization.objects.get(
                 id=organization_id,
-                tenant=self.request.tenant
+                tenant=self.request.tenant,
+                deleted_at__isnull=True
             )
         except Organization.DoesNotExist:
             raise ValidationError({"detail": "Invalid organization for the current tenant."})
@@ -131,32 +271,31 @@ class DepartmentViewSet(viewsets.ModelViewSet):
         """
         Ensure the department belongs to the current tenant and organization.
         """
-        if instance.organization.tenant != self.request.tenant:
+        if instance.tenant_id != self.request.tenant.id:
             raise PermissionDenied("You do not have permission to modify this department.")
 
-        if organization_id:
-            organization = get_object_or_404(Organization, id=organization_id, tenant=self.request.tenant)
-            if instance.organization != organization:
-                raise PermissionDenied("You cannot move the department to a different organization.")
-
-    def update(self, request, *args, **kwargs):
-        instance = self.get_object()
-        organization_id = request.data.get('organization')
-        self.validate_department(instance, organization_id)
-        return super().update(request, *args, **kwargs)
+        if organization_id and str(organization_id) != str(instance.organization_id):
+            get_object_or_404(Organization, id=organization_id, tenant=self.request.tenant, deleted_at__isnull=True)
+            raise PermissionDenied("You cannot move the department to a different organization.")
 
-    def partial_update(self, request, *args, **kwargs):
-        instance = self.get_object()
-        organization_id = request.data.get('organization')
-        self.validate_department(instance, organization_id)
-        return super().partial_update(request, *args, **kwargs)
+    def validate_update(self, instance):
+        self.validate_department(instance, self.request.data.get('organization'))
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         self.validate_department(instance)
         return super().destroy(request, *args, **kwargs)
 
-class CustomerViewSet(viewsets.ModelViewSet):
+    @swagger_auto_schema(manual_parameters=[UPSERT_PARAMETER])
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create many departments at once from a JSON array or NDJSON.
+        With upsert, rows matching (organization, name) of an existing department are skipped.
+        """
+        return bulk_write(request, DepartmentBulkWriter)
+
+class CustomerViewSet(VersionedUpdateMixin, TenantCachedResponseMixin, ValuesListMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing customers.
     Customers are filtered by department and tenant.
@@ -164,7 +303,8 @@ class CustomerViewSet(viewsets.ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
     permission_classes = [CustomerPermission]
-    authentication_classes = [TokenAuthentication]
+    pagination_class = TenantCursorPagination
+    authentication_classes = [CachedTokenAuthentication]
 
     @swagger_auto_schema(
         manual_parameters=[
@@ -175,13 +315,27 @@ class CustomerViewSet(viewsets.ModelViewSet):
         """
         List customers within a specific department.
         """
-        queryset = self.get_queryset()
-        if not queryset.exists():
+        return super().list(request, *args, **kwargs)
+
+    def list_response(self, request, *args, **kwargs):
+        response = super().list_response(request, *args, **kwargs)
+        if response.data['results']:
+            return response
+
+        # Empty page: one query tells a foreign department from an empty one
+        has_customers = Department.objects.filter(
+            id=self.get_department_id(), tenant=request.tenant, organization__deleted_at__isnull=True
+        ).annotate(
+            has_customers=Exists(Customer.objects.filter(department=OuterRef('pk')))
+        ).values_list('has_customers', flat=True).first()
+        if has_customers is None:
+            raise ValidationError({"detail": "Invalid department for the current tenant."})
+        if not has_customers:
             return Response(
                 {"detail": "No customers found for the given department."},
                 status=status.HTTP_404_NOT_FOUND
             )
-        return super().list(request, *args, **kwargs)
+        return response
 
     def get_queryset(self):
         """
@@ -190,59 +344,162 @@ class CustomerViewSet(viewsets.ModelViewSet):
         if 'pk' in self.kwargs:
             return Customer.objects.filter(
                 pk=self.kwargs['pk'],
-                department__organization__tenant=self.request.tenant,
+                tenant=self.request.tenant,
+                department__organization__deleted_at__isnull=True,
             )
 
-        department_id = self.request.query_params.get('department')
-        if not department_id:
-            raise ValidationError({"detail": "Parameter 'department' is required in query params."})
-
-        if not Department.objects.filter(
-            id=department_id, organization__tenant=self.request.tenant
-        ).exists():
-            raise ValidationError({"detail": "Invalid department for the current tenant."})
-
+        # Ownership of the department is implied by the tenant filter, it is
+        # checked separately only when the page is empty (see list_response)
         return Customer.objects.filter(
-            department=department_id,
-            department__organization__tenant=self.request.tenant
-        ).select_related('department__organization')
+            department=self.get_department_id(),
+            tenant=self.request.tenant,
+            department__organization__deleted_at__isnull=True
+        )
+
+    def get_department_id(self):
+        department_id = get_id_param(self.request, 'department')
+        if department_id is None:
+            raise ValidationError({"detail": "Parameter 'department' is required in query params."})
+        return department_id
 
     def perform_create(self, serializer):
         """
         Automatically associate the customer with a department and its hierarchy.
         """
         department_id = self.request.data.get('department')
-        department = Department.objects.get(
-            id=department_id,
-            organization__tenant=self.request.tenant
-        )
+        try:
+            department = Department.objects.get(
+                id=department_id,
+                tenant=self.request.tenant,
+                organization__deleted_at__isnull=True
+            )
+        except Department.DoesNotExist:
+            raise ValidationError({"detail": "Invalid department for the current tenant."})
         serializer.save(department=department)
 
     def validate_customer(self, instance, department_id=None):
         """
         Ensure the customer belongs to the current tenant and department.
         """
-        if instance.department.organization.tenant != self.request.tenant:
+        if instance.tenant_id != self.request.tenant.id:
             raise PermissionDenied("You do not have permission to modify this customer.")
 
-        if department_id:
-            department = get_object_or_404(Department, id=department_id, organization__tenant=self.request.tenant)
-            if instance.department != department:
-                raise PermissionDenied("You cannot move the customer to a different department.")
-
-    def update(self, request, *args, **kwargs):
-        instance = self.get_object()
-        department_id = request.data.get('department')
-        self.validate_customer(instance, department_id)
-        return super().update(request, *args, **kwargs)
+        if department_id and str(department_id) != str(instance.department_id):
+            get_object_or_404(
+                Department, id=department_id, tenant=self.request.tenant, organization__deleted_at__isnull=True
+            )
+            raise PermissionDenied("You cannot move the customer to a different department.")
 
-    def partial_update(self, request, *args, **kwargs):
-        instance = self.get_object()
-        department_id = request.data.get('department')
-        self.validate_customer(instance, department_id)
-        return super().partial_update(request, *args, **kwargs)
+    def validate_update(self, instance):
+        self.validate_customer(instance, self.request.data.get('department'))
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         self.validate_customer(instance)
         return super().destroy(request, *args, **kwargs)
+
+    @swagger_auto_schema(manual_parameters=[UPSERT_PARAMETER])
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create many customers at once from a JSON array or NDJSON.
+        With upsert, rows matching (department, email) of an existing customer update its names.
+        """
+        return bulk_write(request, CustomerBulkWriter)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('organization', openapi.IN_QUERY, description="ID of the organization", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('department', openapi.IN_QUERY, description="ID of the department", type=openapi.TYPE_INTEGER),
+            OUTPUT_PARAMETER,
+        ]
+    )
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Stream all customers of the current tenant, optionally filtered by organization or department.
+        """
+        queryset = Customer.objects.filter(tenant=request.tenant, department__organization__deleted_at__isnull=True)
+        organization_id = get_id_param(request, 'organization')
+        if organization_id is not None:
+            queryset = queryset.filter(department__organization=organization_id)
+        department_id = get_id_param(request, 'department')
+        if department_id is not None:
+            queryset = queryset.filter(department=department_id)
+        return export_response(request, queryset, CUSTOMER_EXPORT_FIELDS, f'{request.tenant.domain}-customers')
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, description="Words matched as prefixes of first name, last name and email", type=openapi.TYPE_STRING, required=True),
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Number of results per page", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('offset', openapi.IN_QUERY, description="Index of the first result", type=openapi.TYPE_INTEGER),
+        ]
+    )
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Search customers of the current tenant by name and email, best matches first.
+        """
+        return self.cached_response(request, self.search_response)
+
+    def search_response(self, request):
+        query = request.query_params.get('q', '')
+        if not tokenize(query):
+            raise ValidationError({"detail": "Parameter 'q' is required in query params."})
+        paginator = SearchPagination()
+        ranked = paginator.paginate_queryset(search_customers(request.tenant, query), request, view=self)
+
+        # One query for the page's customers, put back in rank order
+        fields = values_fields(CustomerSerializer)
+        rows = Customer.objects.filter(
+            id__in=[match['customer_id'] for match in ranked], tenant=request.tenant,
+            department__organization__deleted_at__isnull=True,
+        ).values(*[lookup for _, lookup in fields])
+        by_id = {row['id']: row for row in rows}
+        results = [
+            {**{key: by_id[match['customer_id']][lookup] for key, lookup in fields}, 'rank': match['rank']}
+            for match in ranked if match['customer_id'] in by_id
+        ]
+        return paginator.get_paginated_response(results)
+
+class StatsViewSet(viewsets.ViewSet):
+    """
+    Maintained counts of the current tenant, an organization or a department.
+    """
+    permission_classes = [TenantPermission]
+    authentication_classes = [CachedTokenAuthentication]
+
+    # Query parameter -> (counter level, permission required, counters shown)
+    LEVELS = {
+        'department': (TenantCounter.DEPARTMENT, 'tenants.can_access_department', ['customers']),
+        'organization': (TenantCounter.ORGANIZATION, 'tenants.can_access_organization', ['departments', 'customers']),
+    }
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('organization', openapi.IN_QUERY, description="ID of the organization", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('department', openapi.IN_QUERY, description="ID of the department", type=openapi.TYPE_INTEGER),
+        ]
+    )
+    def list(self, request):
+        """
+        Numbers of organizations, departments and customers, read from one counter row.
+        Without parameters the counts of the whole tenant are returned.
+        """
+        tenant = request.tenant
+        level, object_id, fields = TenantCounter.TENANT, tenant.id, ['organizations', 'departments', 'customers']
+        for param, (param_level, permission, param_fields) in self.LEVELS.items():
+            value = get_id_param(request, param)
+            if value is not None:
+                if not has_indexed_perm(request.user, permission):
+                    raise PermissionDenied("You do not have the required permissions.")
+                level, object_id, fields = param_level, value, param_fields
+                break
+
+        counts = TenantCounter.objects.filter(tenant=tenant, level=level, object_id=object_id).values(*fields).first()
+        if counts is None:
+            if level != TenantCounter.TENANT:
+                return Response({"detail": f"No {level} found for the current tenant."}, status=status.HTTP_404_NOT_FOUND)
+            # A tenant gets its row with its first organization
+            counts = dict.fromkeys(fields, 0)
+        return Response({'level': level, 'id': object_id, **counts})